@@ -1,35 +1,127 @@
-import html, json, os, re, socket, sublime, sublime_plugin, threading
-from collections import defaultdict
-from .src import bencode
-from typing import Any, Dict
+import bisect, concurrent.futures, hashlib, heapq, html, itertools, json, math, os, re, selectors, socket, sublime, sublime_plugin, threading, time, traceback
+from collections import defaultdict, deque, OrderedDict
+from .src import bencode, forms
+from typing import Any, Callable, Dict
 
 ns = 'sublime-clojure-repl'
 
-class Eval:
-    # class
-    next_id:   int = 10
+def settings():
+    return sublime.load_settings(f"{ns}.sublime-settings")
+
+class Config:
+    "Settings read on the hot path, cached until settings change"
+    def __init__(self):
+        self.debug = False
+        self.ui_update_interval = 50
+        self.output_limit = 100000
+        self.output_panel_size = 200000
+        self.value_page_size = 50
+        self.trace_frames = 20
+        self.lookup_cache_size = 1000
+        self.lookup_prefetch = False
+        self.trace_file = None
+        self.version = 0 # bumped on every change, invalidates rendered HTML
+
+    def reload(self):
+        self.debug = settings().get("debug", False)
+        self.ui_update_interval = settings().get("ui_update_interval", 50)
+        self.output_limit = settings().get("output_limit", 100000)
+        self.output_panel_size = settings().get("output_panel_size", 200000)
+        self.value_page_size = settings().get("value_page_size", 50)
+        self.trace_frames = settings().get("trace_frames", 20)
+        self.lookup_cache_size = settings().get("lookup_cache_size", 1000)
+        self.lookup_prefetch = settings().get("lookup_prefetch", False)
+        self.trace_file = settings().get("trace_file")
+        self.version += 1
+
+config = Config()
+
+class UI:
+    """Collects view updates coming from any thread and applies them on the
+    main thread, at most once per `ui_update_interval` ms. Updates share a
+    key per thing they redraw (an eval, the status bar), and only the latest
+    update for each key runs. The rest are counted in `coalesced`."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending: dict[Any, Callable[[], None]] = {}
+        self.scheduled = False
+        self.last_flush = 0
+        self.flushes = 0
+        self.coalesced = 0
+        self.busy = 0.0 # seconds spent in callbacks
+
+    def schedule(self, key, callback):
+        with self.lock:
+            if key in self.pending:
+                self.coalesced += 1
+            self.pending[key] = callback
+            if not self.scheduled:
+                self.scheduled = True
+                delay = self.last_flush + config.ui_update_interval / 1000 - time.time()
+                sublime.set_timeout(self.flush, max(0, int(delay * 1000)))
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.scheduled = False
+            self.last_flush = time.time()
+            self.flushes += 1
+        start = time.perf_counter()
+        for callback in pending.values():
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+        self.busy += time.perf_counter() - start
+
+ui = UI()
+
+_ids = itertools.count(10) # 1..4 are used by the handshake
+
+def next_id():
+    """Unique id for a new request, safe to call from any thread"""
+    return next(_ids)
 
-    # instance
+class Eval:
     id:        int
     view:      sublime.View
-    status:    str # "clone" | "eval" | "interrupt" | "success" | "exception"
+    status:    str # "clone" | "eval" | "interrupt" | "success" | "exception" | "stale"
+    value:     str
     code:      str
     session:   str
     msg:       Dict[str, Any]
+    defines:   list # namespaces to invalidate in LookupCache when done
+    reload:    "Reload" # Eval Buffer this eval is part of
     trace:     str
+    trace_ref: int # exception kept by the server, see wrap-errors
     trace_key: int
+    trace_html: Dict[bool, str] # expanded? -> phantom body
+    value_ref: int # collection kept by the server, see wrap-values
+    page:      list
+    page_more: bool
     
     def __init__(self, view, region, status, value):
-        self.id = Eval.next_id
+        self.id = next_id()
         self.view = view
         self.status = status
+        self.value = value
+        self.pending_region = None
         self.code = view.substr(region)
         self.session = None
         self.msg = None
+        self.defines = []
+        self.reload = None
         self.trace = None
+        self.trace_ref = None
         self.trace_key = None
+        self.trace_html = {}
+        self.trace_html_version = None
+        self.trace_expanded = False
+        self.value_ref = None
+        self.page = []
+        self.page_more = False
+        self.page_shown = False
 
-        Eval.next_id += 1
         scope, color = self.scope_color()
         view.add_regions(self.value_key(), [region], scope, '', sublime.DRAW_NO_FILL, [value], color)
 
@@ -41,9 +133,17 @@ class Eval:
             return ("region.greenish", '#7CCE9B')
         elif "exception" == self.status:
             return ("region.redish", '#DD1730')
+        elif "stale" == self.status:
+            return ("comment", '#A0A0A0')
         else:
             return ("region.bluish", '#7C9BCE')
 
+    def annotation(self):
+        text = html.escape(self.value)
+        if self.value_ref:
+            text += ' <a href="expand">⋯</a>'
+        return text
+
     def region(self):
         regions = self.view.get_regions(self.value_key())
         if regions and len(regions) >= 1:
@@ -51,251 +151,1366 @@ class Eval:
 
     def update(self, status, value, region = None):
         self.status = status
-        region = region or self.region()
+        self.value = value
+        if region:
+            self.pending_region = region
+            evals_of(self.view).move(self, region)
+        ui.schedule(self.value_key(), self.redraw)
+
+    def redraw(self):
+        region = self.pending_region or self.region()
+        self.pending_region = None
         if region:
             scope, color = self.scope_color()
-            self.view.add_regions(self.value_key(), [region], scope, '', sublime.DRAW_NO_FILL, [value], color)            
+            self.view.add_regions(self.value_key(), [region], scope, '', sublime.DRAW_NO_FILL, [self.annotation()], color, on_navigate = self.on_navigate)
+
+    def on_navigate(self, href):
+        if href == "expand":
+            self.page = []
+            self.page_more = False
+        self.fetch_page()
+
+    def fetch_page(self):
+        """Asks server for the next `value_page_size` elements of the value,
+        instead of printing all of it at once"""
+        if not self.value_ref:
+            self.show_page()
+            return
+        future = self.conn.request("page",
+                                   ref = self.value_ref,
+                                   offset = len(self.page),
+                                   limit = config.value_page_size)
+        def on_done(future):
+            if not future.cancelled() and not future.exception():
+                reply = future.result()
+                if "unknown-ref" in reply.get("status", []):
+                    self.value_ref = None
+                else:
+                    self.page += reply.get("items", [])
+                    self.page_more = reply.get("more") == 1
+                ui.schedule(("page", self.id), self.show_page)
+        future.add_done_callback(on_done)
+
+    def show_page(self):
+        region = self.region()
+        if not region:
+            return
+        body = """<body>
+                  <style>
+                    body { padding: 0; margin: 0; }
+                    a { text-decoration: none; }
+                    p { margin: 0; padding: .125rem .5rem; }
+                  </style>"""
+        if self.value_ref:
+            body += "".join(f"<p>{html.escape(item)}</p>" for item in self.page)
+            if self.page_more:
+                body += '<p><a href="more">more…</a></p>'
+        else:
+            body += "<p>Value is no longer kept by the server, evaluate again</p>"
+        body += "</body>"
+        if self.page_shown:
+            self.view.update_popup(body)
+        else:
+            def on_hide():
+                self.page_shown = False
+            self.page_shown = True
+            self.view.show_popup(body, location = region.end(), max_width = 1024, on_navigate = self.on_navigate, on_hide = on_hide)
 
     def toggle_trace(self):
-        if self.trace:
-            if self.trace_key:
-                self.view.erase_phantom_by_id(self.trace_key)
-                self.trace_key = None
-            else:
-                settings = self.view.settings()
-                top = settings.get('line_padding_top', 0)
-                bottom = settings.get('line_padding_bottom', 0)
-                body = f"""<style>
-                    body {{ background-color: #F7D3D5; padding-top: {top}px; padding-bottom: {bottom}px; }}
-                    p {{ margin: 0; padding-top: {top}px; padding-bottom: {bottom}px; }}
-                </style>"""
-                for line in html.escape(self.trace).split("\n"):
-                    body += "<p>" + line.replace("\t", "&nbsp;&nbsp;") + "</p>"
-                region = self.region()
-                if region:
-                    point = self.view.line(region.end()).begin()
-                    self.trace_key = self.view.add_phantom(self.value_key(), sublime.Region(point, point), body, sublime.LAYOUT_BLOCK)
+        if self.trace_key:
+            self.view.erase_phantom_by_id(self.trace_key)
+            self.trace_key = None
+        elif self.trace:
+            self.show_trace()
+        elif self.trace_ref:
+            self.fetch_trace()
+
+    def fetch_trace(self):
+        "Traces are only printed by the server when asked for"
+        future = self.conn.request("trace", ref = self.trace_ref, session = self.conn.session)
+        def on_done(future):
+            if not future.cancelled() and not future.exception():
+                reply = future.result()
+                if "unknown-ref" in reply.get("status", []):
+                    self.trace_ref = None
+                elif "trace" in reply:
+                    self.trace = reply["trace"]
+                    ui.schedule(("trace", self.id), self.show_trace)
+        future.add_done_callback(on_done)
+
+    def trace_body(self):
+        """Phantom HTML for the trace, rendered once per settings change. Unless
+        expanded, only first `trace_frames` frames are shown"""
+        if self.trace_html_version != config.version:
+            self.trace_html.clear()
+            self.trace_html_version = config.version
+        body = self.trace_html.get(self.trace_expanded)
+        if body == None:
+            settings = self.view.settings()
+            top = settings.get('line_padding_top', 0)
+            bottom = settings.get('line_padding_bottom', 0)
+            lines = self.trace.rstrip("\n").split("\n")
+            hidden = 0
+            if config.trace_frames and not self.trace_expanded:
+                frames = [i for i, line in enumerate(lines) if line.startswith("\tat ")]
+                if len(frames) > config.trace_frames:
+                    cut = frames[config.trace_frames]
+                    hidden = len(lines) - cut
+                    lines = lines[:cut]
+            parts = [f"""<style>
+                body {{ background-color: #F7D3D5; padding-top: {top}px; padding-bottom: {bottom}px; }}
+                p {{ margin: 0; padding-top: {top}px; padding-bottom: {bottom}px; }}
+            </style>"""]
+            parts += ["<p>" + html.escape(line).replace("\t", "&nbsp;&nbsp;") + "</p>" for line in lines]
+            if hidden:
+                parts.append(f'<p>&nbsp;&nbsp;<a href="expand">... {hidden} more lines</a></p>')
+            body = "".join(parts)
+            self.trace_html[self.trace_expanded] = body
+        return body
+
+    def show_trace(self):
+        if self.trace and not self.trace_key:
+            region = self.region()
+            if region:
+                point = self.view.line(region.end()).begin()
+                self.trace_key = self.view.add_phantom(self.value_key(), sublime.Region(point, point), self.trace_body(), sublime.LAYOUT_BLOCK, on_navigate = self.expand_trace)
+
+    def expand_trace(self, href):
+        if self.trace_key:
+            self.view.erase_phantom_by_id(self.trace_key)
+            self.trace_key = None
+        self.trace_expanded = True
+        self.show_trace()
 
     def erase(self):
+        ui.schedule(self.value_key(), self.erase_now)
+
+    def erase_now(self):
         self.view.erase_regions(self.value_key())
         if self.trace_key:
             self.view.erase_phantom_by_id(self.trace_key)
 
-class Connection:
+class ViewEvals:
+    """Evals of one view, sorted by position. Eval regions don't overlap, so
+    begins and ends are both sorted. Positions are mirrored here and shifted
+    on every text change, so finding evals at a point or in a range is a
+    bisect, not an API call per eval. If a change was missed (change_count
+    moved on without us), positions are reread from the view."""
+    def __init__(self, view):
+        self.view = view
+        self.lock = threading.RLock()
+        self.begins: list[int] = []
+        self.ends: list[int] = []
+        self.evals: list[Eval] = []
+        self.version = view.change_count()
+
+    def sync(self):
+        version = self.view.change_count()
+        if version != self.version:
+            entries = []
+            for eval in self.evals:
+                region = eval.pending_region or eval.region()
+                if region:
+                    entries.append((region.begin(), region.end(), eval))
+            entries.sort(key = lambda e: e[0])
+            self.begins = [e[0] for e in entries]
+            self.ends = [e[1] for e in entries]
+            self.evals = [e[2] for e in entries]
+            self.version = version
+
+    def add(self, eval, region):
+        with self.lock:
+            self.sync()
+            i = bisect.bisect_left(self.begins, region.begin())
+            self.begins.insert(i, region.begin())
+            self.ends.insert(i, region.end())
+            self.evals.insert(i, eval)
+
+    def remove(self, eval):
+        with self.lock:
+            for i, e in enumerate(self.evals):
+                if e is eval:
+                    del self.begins[i], self.ends[i], self.evals[i]
+                    break
+
+    def move(self, eval, region):
+        with self.lock:
+            self.remove(eval)
+            self.add(eval, region)
+
+    def at(self, point):
+        "Eval whose region contains point"
+        with self.lock:
+            self.sync()
+            i = bisect.bisect_right(self.begins, point) - 1
+            if i >= 0 and point <= self.ends[i]:
+                return self.evals[i]
+
+    def overlapping(self, region):
+        "Evals intersecting region, touching ends included"
+        with self.lock:
+            self.sync()
+            i = bisect.bisect_left(self.ends, region.begin())
+            j = bisect.bisect_right(self.begins, region.end())
+            return self.evals[i:j]
+
+    def edit(self, a, b, length):
+        """Text between a and b was replaced with `length` characters. Shifts
+        evals after the change, returns evals whose text was changed"""
+        with self.lock:
+            delta = length - (b - a)
+            i = bisect.bisect_right(self.ends, a)
+            j = bisect.bisect_left(self.begins, b)
+            j = max(i, j)
+            changed = self.evals[i:j]
+            self.begins[i:] = [p + delta for p in self.begins[j:]]
+            self.ends[i:] = [p + delta for p in self.ends[j:]]
+            self.evals[i:] = self.evals[j:]
+            return changed
+
+view_evals: Dict[int, ViewEvals] = {}
+
+def evals_of(view):
+    evals = view_evals.get(view.id())
+    if not evals:
+        evals = ViewEvals(view)
+        view_evals[view.id()] = evals
+    return evals
+
+def combine_replies(replies):
+    """Merges replies to one request the way nrepl.core/combine-responses
+    does: "value"s are collected into a list, "out"/"err" concatenated,
+    "status" merged, for everything else last one wins"""
+    res = {}
+    for reply in replies:
+        for k, v in reply.items():
+            if k == "value":
+                res.setdefault("value", []).append(v)
+            elif k in {"out", "err"}:
+                res[k] = res.get(k, "") + v
+            elif k == "status":
+                status = res.setdefault("status", [])
+                for s in v:
+                    if s not in status:
+                        status.append(s)
+            else:
+                res[k] = v
+    return res
+
+class Reload:
+    """One Eval Buffer: hashes of all top-level forms of the buffer as they
+    were sent. Once every eval of it succeeds, they replace
+    conn.evaluated[buffer_id]"""
+    def __init__(self, buffer_id, hashes):
+        self.buffer_id = buffer_id
+        self.hashes = hashes
+        self.left = 0
+        self.failed = False
+
+    def add(self, eval):
+        "Called before eval is sent, so on_done can't run before all are added"
+        eval.reload = self
+        self.left += 1
+
+    def on_done(self, conn, eval):
+        self.left -= 1
+        self.failed = self.failed or eval.status != "success"
+        if self.left == 0 and not self.failed:
+            conn.evaluated[self.buffer_id] = self.hashes
+
+class Request:
+    "A sent message waiting for its replies, see Connection.send"
+    def __init__(self, id, op, handler):
+        self.id = id
+        self.op = op
+        self.handler = handler
+
+class Histogram:
+    "Durations in power-of-two millisecond buckets: <=1, <=2, <=4, ..."
     def __init__(self):
-        self.host = 'localhost'
-        self.port = 5555
+        self.buckets = [0] * 16
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.buckets[min(15, max(0, math.ceil(math.log2(ms))) if ms > 0 else 0)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        "Upper bound of the bucket p-th percentile falls into"
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= p * self.count:
+                return min(2 ** i, self.max)
+        return self.max
+
+class Stats:
+    """Timings and traffic of a connection. Every request is timestamped
+    when sent, on its first reply and on "done": send -> first reply is
+    mostly network and queueing, first reply -> done is mostly the JVM.
+    Time spent decoding and handling replies on our side is summed up
+    separately. With `trace_file` set, each finished request is also
+    appended there as a JSON line."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.decoding = 0.0
+        self.handling = 0.0
+        self.writes = 0
+        self.inflight: dict[Any, list] = {} # id -> [op, sent, first reply, bytes sent]
+        self.first: dict[str, Histogram] = defaultdict(Histogram)
+        self.done: dict[str, Histogram] = defaultdict(Histogram)
+
+    def on_send(self, msg, size):
+        with self.lock:
+            self.sent += 1
+            self.bytes_sent += size
+            self.inflight[msg.get("id")] = [msg.get("op"), time.time(), None, size]
+
+    def on_recv(self, size, decoding):
+        with self.lock:
+            self.bytes_received += size
+            self.decoding += decoding
+
+    def on_reply(self, msg):
+        now = time.time()
+        with self.lock:
+            self.received += 1
+            request = self.inflight.get(msg.get("id"))
+            if request:
+                op, sent, first, size = request
+                if first == None:
+                    request[2] = first = now
+                    self.first[op].add((now - sent) * 1000)
+                if "done" in msg.get("status", []):
+                    del self.inflight[msg.get("id")]
+                    self.done[op].add((now - sent) * 1000)
+                    if config.trace_file:
+                        write_trace({"conn": self.conn.name(), "id": msg.get("id"), "op": op,
+                                     "sent": sent, "first": first, "done": now, "bytes_sent": size})
+
+    def on_handled(self, handling):
+        with self.lock:
+            self.handling += handling
+
+    def report(self):
+        kb = lambda n: f"{n / 1024:.1f} KB"
+        lines = [self.conn.name(),
+                 f"  sent {self.sent} msgs / {kb(self.bytes_sent)} in {self.writes} writes, queued {kb(self.conn.outgoing_size)}",
+                 f"  received {self.received} msgs / {kb(self.bytes_received)}",
+                 f"  decoding {self.decoding * 1000:.1f} ms, handling {self.handling * 1000:.1f} ms, in flight {len(self.inflight)}",
+                 "",
+                 f"  {'op':<16}{'count':>7}{'first p50':>11}{'p99':>8}{'done p50':>10}{'p99':>8}{'max':>9}   done histogram, ms"]
+        with self.lock:
+            for op, done in sorted(self.done.items(), key = lambda e: -e[1].count):
+                first = self.first[op]
+                histogram = " ".join(f"≤{2 ** i}:{n}" for i, n in enumerate(done.buckets) if n)
+                lines.append(f"  {op:<16}{done.count:>7}{first.percentile(0.5):>11.1f}{first.percentile(0.99):>8.1f}"
+                             f"{done.percentile(0.5):>10.1f}{done.percentile(0.99):>8.1f}{done.max:>9.1f}   {histogram}")
+        return "\n".join(lines)
+
+trace_files = {}
+
+def write_trace(record):
+    path = config.trace_file
+    file = trace_files.get(path)
+    if not file:
+        for old in trace_files.values():
+            old.close()
+        trace_files.clear()
+        file = trace_files[path] = open(os.path.expanduser(path), "a")
+    file.write(json.dumps(record) + "\n")
+    file.flush()
+
+class SessionPool:
+    """Sessions cloned ahead of time. Every eval leases one for its whole
+    duration, so evals never queue behind each other and an interrupt only
+    hits its own eval. When all sessions are busy a new one is cloned;
+    sessions above `session_pool_size` are closed after sitting idle for
+    `session_idle_timeout` seconds. With a size of 0 sessions are closed as
+    soon as their eval is done. take and lease run on the main thread, the
+    rest on the loop thread."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.idle: list[tuple[str, float]] = [] # (session, released at)
+        self.leases: dict[int, str] = {}        # eval id -> session
+        self.cloning: set[int] = set()          # ids of pending clone requests
+
+    def fill(self):
+        size = settings().get("session_pool_size", 2)
+        ids = []
+        with self.lock:
+            while len(self.idle) + len(self.cloning) < size:
+                id = next_id()
+                self.cloning.add(id)
+                ids.append(id)
+        for id in ids:
+            self.conn.send({"op": "clone", "session": self.conn.session, "id": id}, handle_pool_clone)
+
+    def on_clone(self, id, session):
+        with self.lock:
+            self.cloning.discard(id)
+            self.idle.append((session, time.time()))
+
+    def take(self):
+        "Most recently released idle session, or None"
+        with self.lock:
+            if self.idle:
+                session, _ = self.idle.pop()
+                return session
+
+    def lease(self, id, session):
+        "Marks session as busy until the request with this id is done"
+        with self.lock:
+            self.leases[id] = session
+
+    def release(self, id):
+        size = settings().get("session_pool_size", 2)
+        with self.lock:
+            session = self.leases.pop(id, None)
+            if not session:
+                return
+            if size > 0:
+                self.idle.append((session, time.time()))
+                extra = len(self.idle) > size
+        if size <= 0:
+            self.conn.send({"op": "close", "session": session, "id": next_id()})
+        elif extra:
+            loop.call_later(settings().get("session_idle_timeout", 60), self.shrink)
+
+    def shrink(self):
+        if self.conn.pool is not self:
+            return
+        size = settings().get("session_pool_size", 2)
+        deadline = time.time() - settings().get("session_idle_timeout", 60)
+        closed = []
+        with self.lock:
+            # idle is ordered by release time, oldest first
+            while len(self.idle) > size and self.idle[0][1] <= deadline:
+                closed.append(self.idle.pop(0)[0])
+        for session in closed:
+            self.conn.send({"op": "close", "session": session, "id": next_id()})
+
+class Output:
+    """Output panel of a connection. out/err chunks arriving on the loop
+    thread are collected in `pending` and appended to the panel in one go
+    per UI flush. The panel keeps the last `output_panel_size` characters,
+    older lines are dropped. While no window shows this connection, output
+    stays in `pending`, trimmed to the same size."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.pending: list[str] = []
+
+    def panel_name(self):
+        return f"Clojure REPL {self.conn.name()}"
+
+    def append(self, text):
+        with self.lock:
+            self.pending.append(text)
+        ui.schedule(("output", id(self)), self.flush)
+
+    def flush(self):
+        size = config.output_panel_size
+        windows = [window for window in sublime.windows() if conns.for_window(window) is self.conn]
+        with self.lock:
+            text = "".join(self.pending)
+            if len(text) > size:
+                text = text[-size:]
+            self.pending[:] = [text] if text and not windows else []
+        if not text:
+            return
+        name = self.panel_name()
+        for window in windows:
+            panel = window.find_output_panel(name)
+            if not panel:
+                panel = window.create_output_panel(name)
+                window.run_command("show_panel", {"panel": "output." + name})
+            panel.run_command("append", {"characters": text, "force": True, "scroll_to_end": True})
+            if panel.size() > size:
+                panel.run_command("trim_output", {"size": size})
+
+class TrimOutputCommand(sublime_plugin.TextCommand):
+    "Erases whole lines from the beginning until view fits in size"
+    def run(self, edit, size):
+        overflow = self.view.size() - size
+        if overflow > 0:
+            self.view.erase(edit, sublime.Region(0, self.view.full_line(overflow - 1).end()))
+
+class LookupCache:
+    """Futures of "lookup" replies by (ns, sym), least recently used first.
+    Requests in flight are cached too, so asking twice sends one request.
+    Rendered popups are kept next to them."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.futures: OrderedDict[tuple, concurrent.futures.Future] = OrderedDict()
+        self.bodies: dict[tuple, str] = {}
+
+    def get(self, ns, sym):
+        key = (ns, sym)
+        with self.lock:
+            future = self.futures.get(key)
+            if future and not (future.done() and (future.cancelled() or future.exception())):
+                self.futures.move_to_end(key)
+                return future
+        future = self.conn.request("lookup", sym = sym, ns = ns, session = self.conn.session)
+        with self.lock:
+            self.futures[key] = future
+            while len(self.futures) > config.lookup_cache_size:
+                old, _ = self.futures.popitem(last = False)
+                self.bodies.pop(old, None)
+        return future
+
+    def contains(self, ns, sym):
+        with self.lock:
+            return (ns, sym) in self.futures
+
+    def body(self, ns, sym, reply):
+        "format_lookup(reply), rendered once per entry"
+        key = (ns, sym)
+        with self.lock:
+            body = self.bodies.get(key)
+        if body == None:
+            body = format_lookup(reply["info"]) if reply.get("info") else "Not found"
+            with self.lock:
+                if key in self.futures:
+                    self.bodies[key] = body
+        return body
+
+    def invalidate(self, ns):
+        """Forgets lookups made from ns and of vars defined in ns"""
+        with self.lock:
+            for key, future in list(self.futures.items()):
+                if key[0] == ns \
+                   or not future.done() \
+                   or (not future.cancelled() and not future.exception() and future.result().get("info", {}).get("ns") == ns):
+                    del self.futures[key]
+                    self.bodies.pop(key, None)
+
+class SymbolIndex:
+    """Public vars of loaded namespaces, pulled in bulk with the "vars" op.
+    Names of each namespace are kept sorted, so completions are a bisect by
+    prefix and hover docs need no round trips. Evaluated namespaces are
+    refreshed one by one, newly loaded ones are fetched on the way."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.vars: dict[str, tuple] = {} # ns -> ([name], [arglists], [doc])
+        self.aliases: dict[str, dict] = {} # ns -> alias -> ns
+        self.refers: dict[str, list] = {} # ns -> [ns]
+
+    def refresh(self, namespaces = None):
+        fields = {"namespaces": namespaces} if namespaces else {}
+        future = self.conn.request("vars", session = self.conn.session, **fields)
+        future.add_done_callback(lambda f: self.on_vars(f, namespaces))
+
+    def on_vars(self, future, requested):
+        if future.cancelled() or future.exception():
+            return
+        reply = future.result()
+        loaded = reply.get("namespaces", [])
+        with self.lock:
+            for name, vars in reply.get("vars", {}).items():
+                vars.sort()
+                self.vars[name] = ([v[0] for v in vars], [v[1] for v in vars], [v[2] for v in vars])
+            self.aliases.update(reply.get("aliases", {}))
+            self.refers.update(reply.get("refers", {}))
+            for name in set(self.vars) - set(loaded):
+                del self.vars[name]
+            missing = [name for name in loaded if name not in self.vars]
+        if requested and missing and not set(missing) <= set(requested):
+            self.refresh(missing)
+
+    def candidates(self, ns, sym):
+        "(namespaces to look in, name part of sym)"
+        if "/" in sym[1:]:
+            alias, name = sym.split("/", 1)
+            return [self.aliases.get(ns, {}).get(alias, alias)], name
+        else:
+            return [ns] + self.refers.get(ns, []), sym
+
+    def resolve(self, ns, sym):
+        "Info of the var sym refers to from ns, in the format of lookup op"
+        with self.lock:
+            targets, name = self.candidates(ns, sym)
+            for target in targets:
+                names, arglists, docs = self.vars.get(target, ([], [], []))
+                i = bisect.bisect_left(names, name)
+                if i < len(names) and names[i] == name:
+                    return {"ns": target, "name": name, "arglists": arglists[i], "doc": docs[i]}
+
+    def complete(self, ns, prefix, limit = 1000):
+        "[(name, ns, arglists)] of vars visible from ns and starting with prefix"
+        res = []
+        with self.lock:
+            targets, name = self.candidates(ns, prefix)
+            for target in targets:
+                names, arglists, docs = self.vars.get(target, ([], [], []))
+                i = bisect.bisect_left(names, name)
+                while i < len(names) and names[i].startswith(name) and len(res) < limit:
+                    res.append((names[i], target, arglists[i]))
+                    i += 1
+        return res
+
+class Connection:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
         self.evals: dict[int, Eval] = {}
+        self.status = None
+        self.output = Output(self)
+        self.stats = Stats(self)
+        self.attempts = 0 # failed reconnects in a row
+        self.write_lock = threading.Lock()
         self.reset()
 
-    def set_status(self, status):
-        self.status = status
-        self.refresh_status()
+    def name(self):
+        return f"{self.host}:{self.port}"
 
-    def refresh_status(self):
-        if sublime.active_window():
-            view = sublime.active_window().active_view()
-            if view:
-                view.set_status(ns, self.status)
+    def ready(self):
+        return self.socket != None and self.session != None
 
-    def send(self, msg):
-        print(">>>", msg)
-        self.socket.sendall(bencode.encode(msg).encode())
+    def set_status(self, status):
+        self.status = status
+        ui.schedule("status", conns.refresh_status)
+
+    def send(self, msg, handler = None):
+        """Sends msg. Replies with the same id are passed to handler(conn, msg)
+        until one with status "done" arrives.
+
+        Never blocks: msg is put into the outgoing queue and written by the
+        loop thread when the socket takes it. Messages queued meanwhile go
+        out together in one write"""
+        if config.debug:
+            print(">>>", msg)
+        data = bencode.encode_bytes(msg)
+        with self.write_lock:
+            if not self.socket:
+                raise ConnectionError(f"Not connected to {self.name()}")
+            if handler:
+                request = Request(msg["id"], msg["op"], handler)
+                self.pending[request.id] = request
+            self.stats.on_send(msg, len(data))
+            idle = not self.outgoing
+            self.outgoing.append(data)
+            self.outgoing_size += len(data)
+        if idle:
+            loop.call_soon(self.on_writable)
+
+    def congested(self):
+        """True while more than `send_queue_limit` bytes wait to be written,
+        e.g. server stopped reading. New evals should wait till it drains"""
+        return self.outgoing_size > (settings().get("send_queue_limit", 16 * 1024 * 1024) or float("inf"))
+
+    def on_writable(self):
+        "Writes as much of the outgoing queue as the socket takes. Loop thread only"
+        with self.write_lock:
+            sock = self.socket
+            if not sock:
+                return
+            try:
+                while self.outgoing:
+                    if len(self.outgoing) > 1 and len(self.outgoing[0]) < 65536:
+                        batch, size = [], 0
+                        while self.outgoing and size < 65536:
+                            batch.append(self.outgoing.popleft())
+                            size += len(batch[-1])
+                        self.outgoing.appendleft(b"".join(batch))
+                    data = self.outgoing[0]
+                    sent = sock.send(data)
+                    self.stats.writes += 1
+                    self.outgoing_size -= sent
+                    if sent < len(data):
+                        self.outgoing[0] = memoryview(data)[sent:]
+                        break
+                    self.outgoing.popleft()
+            except BlockingIOError:
+                pass
+            except OSError:
+                sock = None
+            if sock and self.writing != bool(self.outgoing):
+                self.writing = bool(self.outgoing)
+                loop.watch_writable(self, self.writing)
+        if not sock:
+            self.lost()
+
+    def request(self, op, timeout = None, **fields):
+        """Sends {"op": op, **fields} with a fresh id. Returns a
+        concurrent.futures.Future that resolves to all replies merged by
+        combine_replies once one of them has status "done". It can be
+        waited on from a background thread, wrapped with
+        asyncio.wrap_future, or given callbacks with add_done_callback.
+        Callbacks run on the loop thread.
+
+        The future fails with TimeoutError if no "done" arrives within
+        `timeout` seconds. Cancelling it stops tracking the request."""
+        msg = {"op": op, "id": next_id(), **fields}
+        future = concurrent.futures.Future()
+        replies = []
+
+        def handler(conn, reply):
+            replies.append(reply)
+            if "done" in reply.get("status", []) and future.set_running_or_notify_cancel():
+                if "disconnected" in reply["status"]:
+                    future.set_exception(ConnectionError(f"{conn.name()} disconnected"))
+                else:
+                    future.set_result(combine_replies(replies))
+
+        def forget(future):
+            if future.cancelled():
+                self.pending.pop(msg["id"], None)
+
+        future.add_done_callback(forget)
+        if timeout != None:
+            def expire():
+                if self.pending.pop(msg["id"], None) and future.set_running_or_notify_cancel():
+                    future.set_exception(concurrent.futures.TimeoutError(f"{op} timed out after {timeout} sec"))
+            loop.call_later(timeout, expire)
+        try:
+            self.send(msg, handler)
+        except ConnectionError:
+            handler(self, {"id": msg["id"], "status": ["done", "disconnected"]})
+        return future
 
     def reset(self):
-        self.socket = None
-        self.reader = None
+        with self.write_lock:
+            self.socket = None
+            self.outgoing = deque() # encoded messages not yet taken by the socket
+            self.outgoing_size = 0
+            self.writing = False # socket is watched for EVENT_WRITE
+        self.decoder = None
         self.session = None
+        self.pool = SessionPool(self)
+        self.lookups = LookupCache(self)
+        self.symbols = SymbolIndex(self)
+        # buffer id -> hashes of top-level forms as last loaded by Eval Buffer
+        self.evaluated: dict[int, set] = {}
+        self.pending: dict[int, Request] = {}
+        self.middleware_installed = None
+        self.opened = None
+        self.stats.inflight.clear()
         self.set_status('🌑 Offline')
-        for id, eval in self.evals.items():
-            eval.erase()
-        self.evals.clear()
 
-    def add_eval(self, eval):
+    def open(self, on_failure):
+        """Connects and starts the handshake. Resolving and connecting happen
+        on a short-lived thread, so neither the UI nor the loop wait for DNS
+        or an unreachable host. If the server can't be reached, on_failure()
+        is called on the loop thread"""
+        self.opened = time.time()
+        self.set_status(f"🌑 Connecting to {self.name()}")
+        def connect():
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout = 5)
+                sock.setblocking(False)
+            except OSError as e:
+                print(e)
+                loop.call_soon(on_failure)
+                return
+            loop.call_soon(lambda: self.on_open(sock))
+        loop.start()
+        threading.Thread(daemon = True, target = connect).start()
+
+    def on_open(self, sock):
+        # disconnected by user, or connected by another attempt meanwhile
+        if self not in conns.conns or self.socket:
+            sock.close()
+            return
+        self.decoder = bencode.BencodeDecoder()
+        with self.write_lock:
+            self.socket = sock
+        loop.register(self)
+        self.send({"op": "clone", "id": 1}, handle_connect)
+        self.send({"op": "describe", "id": 4}, handle_connect)
+        self.set_status(f"🌒 Cloning session")
+
+    def add_eval(self, eval, region):
+        eval.conn = self
         self.evals[eval.id] = eval
+        evals_of(eval.view).add(eval, region)
 
     def erase_eval(self, eval):
-        eval.erase()
-        del self.evals[eval.id]
+        if self.evals.pop(eval.id, None):
+            evals_of(eval.view).remove(eval)
+            eval.erase()
 
-    def erase_evals(self, predicate, view = None):
-        for id, eval in list(self.evals.items()):
-            if (view == None or view == eval.view) and predicate(eval):
-                self.erase_eval(eval)
+    def on_readable(self):
+        try:
+            data = self.socket.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = None
+        if not data:
+            self.lost()
+            return
+        start = time.perf_counter()
+        try:
+            msgs = self.decoder.feed(data)
+        except ValueError as e:
+            # decoder is stuck on the bad byte, the stream can't be trusted anymore
+            print(f"{self.name()} sent malformed bencode: {e}")
+            self.lost()
+            return
+        self.stats.on_recv(len(data), time.perf_counter() - start)
+        for msg in msgs:
+            # before handler, it might reuse the id (clone -> eval)
+            self.stats.on_reply(msg)
+            start = time.perf_counter()
+            handle_msg(self, msg)
+            self.stats.on_handled(time.perf_counter() - start)
 
     def disconnect(self):
         if self.socket:
+            loop.unregister(self.socket)
+            self.socket.close()
+        conns.remove(self)
+        self.reset()
+        for id, eval in self.evals.items():
+            evals_of(eval.view).remove(eval)
+            eval.erase()
+        self.evals.clear()
+
+    def lost(self):
+        """Server went away. Evals stay on screen, unfinished ones are marked
+        stale, pending requests fail, and we keep trying to reconnect"""
+        if self.socket:
+            loop.unregister(self.socket)
             self.socket.close()
+            pending = self.pending
             self.reset()
+            for eval in self.evals.values():
+                if eval.status not in {"success", "exception", "stale"}:
+                    eval.update("stale", "Stale: connection lost")
+                else:
+                    # refs count from 0 in every JVM, after a restart they point to someone else's values
+                    eval.trace_ref = None
+                    if eval.value_ref:
+                        eval.value_ref = None
+                        eval.update(eval.status, eval.value)
+            for request in pending.values():
+                request.handler(self, {"id": request.id, "status": ["done", "disconnected"]})
+            self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        delay = min(settings().get("reconnect_max_delay", 30),
+                    settings().get("reconnect_delay", 1) * 2 ** self.attempts)
+        self.attempts += 1
+        self.set_status(f"🌑 Reconnecting to {self.name()} in {delay:g} sec")
+        loop.call_later(delay, self.reconnect)
+
+    def reconnect(self):
+        # disconnected by user, or reconnected by hand meanwhile
+        if self in conns.conns and not self.socket:
+            self.open(self.schedule_reconnect)
+
+    def watch(self):
+        """Sends "describe" every `health_check_interval` seconds. No reply in
+        `health_check_timeout` means the socket is half-open"""
+        loop.start()
+        loop.call_later(settings().get("health_check_interval", 30) or 30, self.ping)
+
+    def ping(self):
+        if self not in conns.conns:
+            return
+        if self.ready() and settings().get("health_check_interval", 30):
+            sock = self.socket
+            def on_done(future):
+                if not future.cancelled() \
+                   and isinstance(future.exception(), concurrent.futures.TimeoutError) \
+                   and self.socket is sock:
+                    print(f"{self.name()} is not responding")
+                    self.lost()
+            self.request("describe", timeout = settings().get("health_check_timeout", 10)).add_done_callback(on_done)
+        self.watch()
+
+class Loop:
+    """Single background thread that reads from and writes to every open
+    connection. Sockets are registered in one selector, so an extra REPL
+    costs a file descriptor, not a thread."""
+    def __init__(self):
+        self.selector = None
+        self.thread = None
+        self.waker = None
+        self.lock = threading.Lock()
+        self.ready = []
+        self.timers = [] # heap of (time, seq, callback)
+        self.seq = itertools.count()
+
+    def start(self):
+        if not self.thread:
+            self.selector = selectors.DefaultSelector()
+            self.waker, wakee = socket.socketpair()
+            self.waker.setblocking(False)
+            wakee.setblocking(False)
+            self.selector.register(wakee, selectors.EVENT_READ)
+            self.thread = threading.Thread(daemon=True, target=self.run)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.thread = None
+            self.wake()
+
+    def wake(self):
+        try:
+            self.waker.send(b"\0")
+        except OSError: # buffer full, loop is awake anyway
+            pass
+
+    def call_soon(self, callback):
+        "Runs callback on the loop thread"
+        with self.lock:
+            self.ready.append(callback)
+        self.wake()
+
+    def call_later(self, delay, callback):
+        "Runs callback on the loop thread in `delay` seconds"
+        with self.lock:
+            heapq.heappush(self.timers, (time.time() + delay, next(self.seq), callback))
+        self.wake()
+
+    def register(self, conn):
+        def register():
+            if conn.socket:
+                self.selector.register(conn.socket, selectors.EVENT_READ, conn)
+        self.call_soon(register)
+
+    def watch_writable(self, conn, writable):
+        "Whether to call conn.on_writable when its socket can take more. Loop thread only"
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writable else 0)
+        try:
+            self.selector.modify(conn.socket, events, conn)
+        except (KeyError, ValueError):
+            pass
+
+    def unregister(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def run(self):
+        thread = self.thread
+        while self.thread == thread:
+            with self.lock:
+                timeout = max(0, self.timers[0][0] - time.time()) if self.timers else None
+            for key, events in self.selector.select(timeout):
+                try:
+                    if key.data:
+                        if events & selectors.EVENT_WRITE:
+                            key.data.on_writable()
+                        if events & selectors.EVENT_READ and key.data.socket is key.fileobj:
+                            key.data.on_readable()
+                    else:
+                        key.fileobj.recv(4096)
+                except Exception:
+                    traceback.print_exc()
+            with self.lock:
+                ready, self.ready = self.ready, []
+                now = time.time()
+                while self.timers and self.timers[0][0] <= now:
+                    ready.append(heapq.heappop(self.timers)[2])
+            for callback in ready:
+                try:
+                    callback()
+                except Exception:
+                    traceback.print_exc()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+        self.waker.close()
+
+class Connections:
+    """All open connections plus the window -> connection routing.
+    Windows that were never routed explicitly use the most recent connection."""
+    def __init__(self):
+        self.conns: list[Connection] = []
+        self.windows: dict[int, Connection] = {}
+        self.offline_status = '🌑 Offline'
+
+    def add(self, conn, window = None):
+        self.conns.append(conn)
+        if window:
+            self.windows[window.id()] = conn
+
+    def remove(self, conn):
+        if conn in self.conns:
+            self.conns.remove(conn)
+        for window_id, c in list(self.windows.items()):
+            if c == conn:
+                del self.windows[window_id]
+        # windows that showed conn fall back to another connection
+        for c in self.conns:
+            ui.schedule(("output", id(c.output)), c.output.flush)
+
+    def find(self, host, port):
+        for conn in self.conns:
+            if conn.host == host and conn.port == port:
+                return conn
+
+    def for_window(self, window):
+        conn = self.windows.get(window.id()) if window else None
+        if not conn and self.conns:
+            conn = self.conns[-1]
+        return conn
+
+    def for_view(self, view):
+        return self.for_window(view.window())
+
+    def route(self, window, conn):
+        self.windows[window.id()] = conn
+        self.refresh_status()
+        conn.output.flush() # might have been kept while no window showed it
+
+    def erase_evals(self, predicate, view):
+        for eval in list(evals_of(view).evals):
+            if predicate(eval):
+                eval.conn.erase_eval(eval)
+
+    def refresh_status(self):
+        window = sublime.active_window()
+        if window:
+            view = window.active_view()
+            if view:
+                conn = self.for_window(window)
+                view.set_status(ns, conn.status if conn else self.offline_status)
 
-conn = Connection()
+    def disconnect_all(self):
+        for conn in list(self.conns):
+            conn.disconnect()
 
-def handle_new_session(msg):
-    if "new-session" in msg and "id" in msg and msg["id"] in conn.evals:
-        eval = conn.evals[msg["id"]]
+loop = Loop()
+conns = Connections()
+
+def handle_new_session(conn, eval, msg):
+    if "new-session" in msg:
         eval.session = msg["new-session"]
         eval.msg["session"] = msg["new-session"]
-        conn.send(eval.msg)
+        conn.pool.lease(eval.id, eval.session)
+        conn.send(eval.msg, handle_eval)
         eval.update("eval", "Evaluating...")
         return True
 
-def handle_value(msg):
-    if "value" in msg and "id" in msg and msg["id"] in conn.evals:
-        eval = conn.evals[msg["id"]]
+def handle_pool_clone(conn, msg):
+    if "new-session" in msg:
+        conn.pool.on_clone(msg["id"], msg["new-session"])
+
+def handle_value(conn, eval, msg):
+    if "value" in msg:
+        eval.value_ref = msg.get(ns + ".middleware/value-ref")
         eval.update("success", msg.get("value"))
         return True
 
-def handle_exception(msg):
-    if "id" in msg and msg["id"] in conn.evals:
-        eval = conn.evals[msg["id"]]
-        get = lambda key: msg.get(ns + ".middleware/" + key)
-        if get("root-ex-class") and get("root-ex-msg"):
-            text = get("root-ex-class") + ": " + get("root-ex-msg")
-            region = None
-            if get("root-ex-data"):
-                text += " " + get("root-ex-data")
-            if get("line") and get("column"):
-                line = get("line")
-                column = get("column")
-                point = eval.view.text_point_utf16(line - 1, column - 1, clamp_column = True)
-                region = sublime.Region(point, eval.view.line(point).end())
-            eval.trace = get("trace")
-            eval.update("exception", text, region)
-            return True
-        elif "root-ex" in msg:
-            eval.update("exception", msg["root-ex"])
-            return True
-        elif "ex" in msg:
-            eval.update("exception", msg["ex"])
-            return True        
-        elif "status" in msg and "namespace-not-found" in msg["status"]:
-            eval.update("exception", f'Namespace not found: {msg["ns"]}')
+def handle_exception(conn, eval, msg):
+    get = lambda key: msg.get(ns + ".middleware/" + key)
+    if get("root-ex-class") and get("root-ex-msg"):
+        text = get("root-ex-class") + ": " + get("root-ex-msg")
+        region = None
+        if get("root-ex-data"):
+            text += " " + get("root-ex-data")
+        if get("line") and get("column"):
+            line = get("line")
+            column = get("column")
+            point = eval.view.text_point_utf16(line - 1, column - 1, clamp_column = True)
+            region = sublime.Region(point, eval.view.line(point).end())
+        eval.trace_ref = get("trace-ref")
+        eval.update("exception", text, region)
+        return True
+    elif "root-ex" in msg:
+        eval.update("exception", msg["root-ex"])
+        return True
+    elif "ex" in msg:
+        eval.update("exception", msg["ex"])
+        return True        
+    elif "status" in msg and "namespace-not-found" in msg["status"]:
+        eval.update("exception", f'Namespace not found: {msg["ns"]}')
+
+def handle_done(conn, eval, msg):
+    if "status" in msg and "done" in msg["status"]:
+        if eval.status == "stale":
+            return
+        if eval.reload:
+            eval.reload.on_done(conn, eval)
+        for name in eval.defines:
+            conn.lookups.invalidate(name)
+        if eval.defines:
+            conn.symbols.refresh(eval.defines)
+        if eval.status not in {"success", "exception"}:
+            conn.erase_eval(eval)
+
+def handle_eval(conn, msg):
+    eval = conn.evals.get(msg["id"])
+    if eval:
+        handle_new_session(conn, eval, msg) \
+        or handle_value(conn, eval, msg) \
+        or handle_exception(conn, eval, msg) \
+        or handle_done(conn, eval, msg)
 
 def namespace(view, point):
-    ns = None
-    for region in view.find_by_selector("entity.name"):
-        if region.end() <= point:
-            begin = region.begin()
-            while begin > 0 and view.match_selector(begin - 1, 'meta.parens'):
-                begin -= 1
-            if re.match(r"\([\s,]*ns[\s,]", view.substr(sublime.Region(begin, region.begin()))):
-                ns = view.substr(region)
-        else:
-            break
-    return ns
+    return form_index(view).namespace_at(point)
 
-def eval_msg(view, region, msg):
-    extended_region = view.line(region)
-    conn.erase_evals(lambda eval: eval.region() and eval.region().intersects(extended_region), view)
-    eval = Eval(view, region, "clone", "Cloning...")
+def new_eval(conn, view, region, msg, status, value, reload = None):
+    eval = Eval(view, region, status, value)
+    if reload:
+        reload.add(eval)
     eval.msg = {k: v for k, v in msg.items() if v}
     eval.msg["id"] = eval.id
-    eval.msg["nrepl.middleware.caught/caught"] = "sublime-clojure-repl.middleware/print-root-trace"
+    eval.defines = defined_namespaces(view, msg)
     eval.msg["nrepl.middleware.print/quota"] = 300
-    conn.add_eval(eval)
-    conn.send({"op": "clone", "session": conn.session, "id": eval.id})
-
-def eval(view, region):
+    if config.value_page_size:
+        eval.msg[ns + ".middleware/keep-value"] = 1
+    if config.output_limit:
+        eval.msg[ns + ".middleware/output-limit"] = config.output_limit
+    conn.add_eval(eval, region)
+    return eval
+
+def defined_namespaces(view, msg):
+    "Namespaces whose vars evaluating msg might (re)define"
+    if msg.get("op") == "load-file":
+        return [name for _, name in form_index(view).ns_names] or ["user"]
+    elif re.search(r"\(\s*(ns\b|def|require\b|use\b|refer\b|alias\b|load\b|[\w\-.]+/def)", msg.get("code", "")):
+        return [msg.get("ns") or "user"]
+    else:
+        return []
+
+def congested(conn):
+    if conn.congested():
+        sublime.status_message(f"{conn.name()} is not keeping up, try again when pending evals are sent")
+        return True
+    return False
+
+def eval_msg(conn, view, region, msg, reload = None):
+    """Evaluates msg, showing the result at region. Returns the Eval or
+    None if the connection is congested. Unless it's part of reload, the
+    buffer no longer matches what Eval Buffer last loaded"""
+    if congested(conn):
+        return None
+    if not reload:
+        conn.evaluated.pop(view.buffer_id(), None)
+    for eval in evals_of(view).overlapping(view.line(region)):
+        eval.conn.erase_eval(eval)
+    session = conn.pool.take()
+    if session:
+        eval = new_eval(conn, view, region, msg, "eval", "Evaluating...", reload)
+        eval.session = session
+        eval.msg["session"] = session
+        conn.pool.lease(eval.id, session)
+        conn.send(eval.msg, handle_eval)
+    else:
+        eval = new_eval(conn, view, region, msg, "clone", "Cloning...", reload)
+        conn.send({"op": "clone", "session": conn.session, "id": eval.id}, handle_eval)
+    return eval
+
+def code_msg(view, region):
     (line, column) = view.rowcol_utf16(region.begin())
-    msg = {"op":     "eval",
-           "code":   view.substr(region),
-           "ns":     namespace(view, region.begin()) or 'user',
-           "line":   line,
-           "column": column,
-           "file":   view.file_name()}
-    eval_msg(view, region, msg)
-    
-def expand_until(view, point, scopes):
-    if view.scope_name(point) in scopes and point > 0:
-        point = point - 1
-    if view.scope_name(point) not in scopes:
-        begin = point
-        while begin > 0 and view.scope_name(begin - 1) not in scopes:
-            begin -= 1
-        end = point
-        while end < view.size() and view.scope_name(end) not in scopes:
-            end += 1
-        return sublime.Region(begin, end)
+    return {"op":     "eval",
+            "code":   view.substr(region),
+            "ns":     namespace(view, region.begin()) or 'user',
+            "line":   line,
+            "column": column,
+            "file":   view.file_name()}
+
+def eval(conn, view, region):
+    eval_msg(conn, view, region, code_msg(view, region))
+
+def eval_pipelined(conn, view, regions, reload = None):
+    """Evaluates regions in order on a single session. All messages are sent
+    at once, nREPL queues them and runs them one by one, so each form sees
+    the definitions before it. The session is leased until the last eval
+    is done. Returns the evals"""
+    if congested(conn):
+        return []
+    if not reload:
+        conn.evaluated.pop(view.buffer_id(), None)
+    if regions:
+        for eval in evals_of(view).overlapping(sublime.Region(regions[0].begin(), regions[-1].end())):
+            eval.conn.erase_eval(eval)
+    # "clone" until send_all gives them a session, there's nothing to interrupt before that
+    evals = [new_eval(conn, view, region, code_msg(view, region), "clone", "Pending...", reload) for region in regions]
+    if not evals:
+        return evals
+
+    def send_all(session):
+        conn.pool.lease(evals[-1].id, session)
+        for eval in evals:
+            eval.session = session
+            eval.msg["session"] = session
+            eval.status = "eval"
+            conn.send(eval.msg, handle_eval)
+
+    session = conn.pool.take()
+    if session:
+        send_all(session)
+    else:
+        future = conn.request("clone", session = conn.session)
+        future.add_done_callback(lambda f: not f.cancelled() and not f.exception() and send_all(f.result()["new-session"]))
+    return evals
+
+form_indexes: Dict[int, forms.FormIndex] = {}
+
+def form_index(view):
+    """Up to date FormIndex of view's buffer. Kept current by TextChangeListener,
+    rebuilt from scratch if any change slipped past it"""
+    index = form_indexes.get(view.buffer_id())
+    if not index:
+        index = forms.FormIndex()
+        form_indexes[view.buffer_id()] = index
+    if index.version != view.change_count():
+        index.reset()
+        index.version = view.change_count()
+    index.refresh(lambda begin: view.substr(sublime.Region(begin, view.size())))
+    return index
+
+class TextChangeListener(sublime_plugin.TextChangeListener):
+    """Keeps FormIndex and ViewEvals positions in sync with edits, erases
+    evals whose code was changed"""
+    @classmethod
+    def is_applicable(cls, buffer):
+        return True
+
+    def on_text_changed(self, changes):
+        index = form_indexes.get(self.buffer.id())
+        if index:
+            for change in changes:
+                index.edit(change.a.pt, change.b.pt, len(change.str))
+            index.version = self.buffer.primary_view().change_count()
+        for view in self.buffer.views():
+            evals = view_evals.get(view.id())
+            if evals:
+                changed = []
+                for change in changes:
+                    changed += evals.edit(change.a.pt, change.b.pt, len(change.str))
+                evals.version = view.change_count()
+                for eval in changed:
+                    eval.conn.erase_eval(eval)
 
 def topmost_form(view, point):
-    region = expand_until(view, point, {'source.clojurec '})
-    if region \
-       and view.substr(region).startswith("(comment") \
-       and point >= region.begin() + len("(comment ") \
-       and point < region.end():
-        return expand_until(view, point, {'source.clojurec meta.parens.clojure ',
-                                          'source.clojurec meta.parens.clojure punctuation.section.parens.end.clojure '})
-    return region
+    form = form_index(view).form_at(point)
+    if form:
+        region = sublime.Region(*form)
+        text = view.substr(region)
+        if text.startswith("(comment") \
+           and point >= region.begin() + len("(comment ") \
+           and point < region.end():
+            end = len(text) - 1 if text.endswith(")") else len(text)
+            child = forms.form_at(text, point - region.begin(), len("(comment"), end)
+            return sublime.Region(region.begin() + child[0], region.begin() + child[1]) if child else None
+        return region
+
+def topmost_forms(view):
+    """All top-level forms of the buffer, in order, without comments and
+    forms discarded with #_"""
+    return [sublime.Region(b, e) for b, e in form_index(view).forms()
+            if view.substr(sublime.Region(b, b + 2)) != "#_"]
 
 class EvalTopmostFormCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         point = self.view.sel()[0].begin()
         region = topmost_form(self.view, point)
         if region:
-            eval(self.view, region)
+            eval(conns.for_view(self.view), self.view, region)
 
     def is_enabled(self):
-        return conn.socket != None \
-            and conn.session != None \
+        conn = conns.for_view(self.view)
+        return conn != None \
+            and conn.ready() \
             and len(self.view.sel()) == 1
 
 class EvalSelectionCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         region = self.view.sel()[0]
-        eval(self.view, region)
+        eval(conns.for_view(self.view), self.view, region)
         
     def is_enabled(self):
-        return conn.socket != None \
-            and conn.session != None \
+        conn = conns.for_view(self.view)
+        return conn != None \
+            and conn.ready() \
             and len(self.view.sel()) == 1 \
             and not self.view.sel()[0].empty()
 
 class EvalBufferCommand(sublime_plugin.TextCommand):
-    def run(self, edit):
+    """Loads the whole buffer with load-file. With `eval_buffer_incremental`,
+    once the buffer has been loaded successfully, only top-level forms that
+    differ from the last successful Eval Buffer are sent, in buffer order.
+    Pass full: true to always load everything"""
+    def run(self, edit, full = False):
         view = self.view
+        conn = conns.for_view(view)
+        regions = topmost_forms(view)
+        hashes = [hash(view.substr(region)) for region in regions]
+        evaluated = conn.evaluated.get(view.buffer_id())
+        if not full and settings().get("eval_buffer_incremental", False) and evaluated != None:
+            changed = [region for region, h in zip(regions, hashes) if h not in evaluated]
+            if changed:
+                eval_pipelined(conn, view, changed, Reload(view.buffer_id(), set(hashes)))
+            else:
+                sublime.status_message("No top-level forms changed since last Eval Buffer")
+            return
         region = sublime.Region(0, view.size())
         file_name = view.file_name()
         msg = {"op":        "load-file",
                "file":      view.substr(region),
                "file-path": file_name,
                "file-name": os.path.basename(file_name) if file_name else "NO_SOURCE_FILE.cljc"}
-        eval_msg(view, region, msg)
+        if not conn.congested():
+            # until it succeeds, nobody knows what's loaded
+            conn.evaluated.pop(view.buffer_id(), None)
+        eval_msg(conn, view, region, msg, Reload(view.buffer_id(), set(hashes)))
         
     def is_enabled(self):
-        return conn.socket != None \
-            and conn.session != None
+        conn = conns.for_view(self.view)
+        return conn != None \
+            and conn.ready()
+
+class EvalAllFormsCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        eval_pipelined(conns.for_view(self.view), self.view, topmost_forms(self.view))
+
+    def is_enabled(self):
+        conn = conns.for_view(self.view)
+        return conn != None \
+            and conn.ready()
 
 class ClearEvalsCommand(sublime_plugin.TextCommand):
     def run(self, edit):
-        conn.erase_evals(lambda eval: eval.status in {"success", "exception"}, self.view)
+        conns.erase_evals(lambda eval: eval.status in {"success", "exception", "stale"}, self.view)
 
 class InterruptEvalCommand(sublime_plugin.TextCommand):
     def run(self, edit):
+        conn = conns.for_view(self.view)
         for eval in conn.evals.values():
-            if eval.status == "eval":
+            if eval.status == "eval" and eval.session:
                 conn.send({"op":           "interrupt",
                            "session":      eval.session,
                            "interrupt-id": eval.id})
                 eval.update("interrupt", "Interrupting...")
 
     def is_enabled(self):
-        return conn.socket != None \
-            and conn.session != None
+        conn = conns.for_view(self.view)
+        return conn != None \
+            and conn.ready()
 
 class ToggleTraceCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         view = self.view
-        point = view.sel()[0].begin()
-        for eval in conn.evals.values():
-            if eval.view == view:
-                region = eval.region()
-                if region and region.contains(point):
-                    eval.toggle_trace()
-                    break
+        eval = evals_of(view).at(view.sel()[0].begin())
+        if eval:
+            eval.toggle_trace()
         
     def is_enabled(self):
-        return conn.socket != None \
-            and conn.session != None \
+        conn = conns.for_view(self.view)
+        return conn != None \
+            and conn.ready() \
             and len(self.view.sel()) == 1
 
 def format_lookup(info):
@@ -343,13 +1558,24 @@ def format_lookup(info):
     body += "</body>"
     return body
 
-def handle_lookup(msg):
-    if "info" in msg:
-        view = sublime.active_window().active_view()
-        if msg["info"]:
-            view.show_popup(format_lookup(msg["info"]), max_width=1024)
-        else:
-            view.show_popup("Not found")
+def visible_symbols(view, limit = 100):
+    """[(ns, symbol)] in the visible part of view. Main thread only: FormIndex
+    is updated from TextChangeListener without a lock"""
+    visible = view.visible_region()
+    seen = {}
+    for region in view.find_by_selector("source.symbol.clojure"):
+        if region.end() < visible.begin():
+            continue
+        if region.begin() > visible.end() or len(seen) >= limit:
+            break
+        seen[(namespace(view, region.begin()) or 'user', view.substr(region))] = True
+    return list(seen)
+
+def prefetch_lookups(conn, keys):
+    "Warms up LookupCache with (ns, symbol) keys"
+    for key in keys:
+        if not conn.lookups.contains(*key):
+            conn.lookups.get(*key)
 
 class LookupSymbolCommand(sublime_plugin.TextCommand):
     def run(self, edit):
@@ -362,17 +1588,19 @@ class LookupSymbolCommand(sublime_plugin.TextCommand):
             elif point > 0 and view.match_selector(point - 1, 'source.symbol.clojure'):
                 region = self.view.extract_scope(point - 1)
         if not region.empty():
-            conn.send({"op":      "lookup",
-                       "sym":     view.substr(region),
-                       "session": conn.session,
-                       "id":      Eval.next_id,
-                       "ns":      namespace(view, region.begin()) or 'user'})
-            Eval.next_id += 1
+            conn = conns.for_view(view)
+            key = (namespace(view, region.begin()) or 'user', view.substr(region))
+            future = conn.lookups.get(*key)
+            def on_done(future):
+                if not future.cancelled() and not future.exception():
+                    ui.schedule(("lookup", view.id()), lambda: view.show_popup(conn.lookups.body(*key, future.result()), max_width=1024))
+            future.add_done_callback(on_done)
 
     def is_enabled(self):
-        if conn.socket == None or conn.session == None:
-            return False
         view = self.view
+        conn = conns.for_view(view)
+        if conn == None or not conn.ready():
+            return False
         if len(view.sel()) > 1:
             return False
         region = view.sel()[0]
@@ -387,103 +1615,158 @@ class LookupSymbolCommand(sublime_plugin.TextCommand):
 
 class EventListener(sublime_plugin.EventListener):
     def on_activated(self, view):
-        conn.refresh_status()
-
-    def on_modified_async(self, view):
-        conn.erase_evals(lambda eval: eval.region() and view.substr(eval.region()) != eval.code, view)
+        conns.refresh_status()
+        if config.lookup_prefetch and view.match_selector(0, "source.clojure"):
+            conn = conns.for_view(view)
+            if conn and conn.ready() and not conn.congested():
+                keys = visible_symbols(view)
+                sublime.set_timeout_async(lambda: prefetch_lookups(conn, keys))
+
+    def on_hover(self, view, point, hover_zone):
+        if hover_zone == sublime.HOVER_TEXT and view.match_selector(point, "source.symbol.clojure"):
+            conn = conns.for_view(view)
+            if conn and conn.ready():
+                region = view.extract_scope(point)
+                info = conn.symbols.resolve(namespace(view, point) or 'user', view.substr(region))
+                if info:
+                    view.show_popup(format_lookup(info), sublime.HIDE_ON_MOUSE_MOVE_AWAY, point, max_width = 1024)
+
+    def on_query_completions(self, view, prefix, locations):
+        point = locations[0]
+        if point > 0 and view.match_selector(point - 1, "source.symbol.clojure"):
+            conn = conns.for_view(view)
+            if conn and conn.ready():
+                region = view.extract_scope(point - 1)
+                typed = view.substr(sublime.Region(region.begin(), point))
+                # Sublime replaces only `prefix`, which stops at word separators
+                skip = len(typed) - len(prefix)
+                if "/" in typed[1:]:
+                    skip -= typed.index("/") + 1
+                skip = max(0, skip)
+                items = []
+                for name, target, arglists in conn.symbols.complete(namespace(view, point) or 'user', typed):
+                    items.append(sublime.CompletionItem(
+                        name[skip:],
+                        annotation = target,
+                        kind = sublime.KIND_FUNCTION if arglists else sublime.KIND_VARIABLE,
+                        details = html.escape(arglists)))
+                return items
 
     def on_close(self, view):
-        conn.erase_evals(lambda eval: True, view)
-
-class SocketIO:
-    def __init__(self, socket):
-        self.socket = socket
-        self.buffer = None
-        self.pos = -1
-
-    def read(self, n):
-        if not self.buffer or self.pos >= len(self.buffer):
-            self.buffer = self.socket.recv(4096)
-            # print("<<<", self.buffer.decode())
-            self.pos = 0
-        begin = self.pos
-        end = min(begin + n, len(self.buffer))
-        self.pos = end
-        return self.buffer[begin:end]
-
-def handle_connect(msg):
+        conns.erase_evals(lambda eval: True, view)
+        view_evals.pop(view.id(), None)
+        if not view.clones():
+            form_indexes.pop(view.buffer_id(), None)
+
+middleware_cache = {}
+
+def middleware():
+    """(source, version) of middleware.clj, read once per plugin load.
+    Version is a hash of the source, uploaded with it and reported back by
+    "describe", so a JVM that already has this exact middleware is not sent
+    it again"""
+    if not middleware_cache:
+        with open(os.path.join(sublime.packages_path(), "sublime-clojure-repl", "src", "middleware.clj"), "r") as file:
+            source = file.read()
+        version = hashlib.sha1(source.encode()).hexdigest()[:12]
+        middleware_cache["source"] = source + f'\n(def version "{version}")\n'
+        middleware_cache["version"] = version
+    return middleware_cache["source"], middleware_cache["version"]
+
+def handle_connect(conn, msg):
+    """Handshake: clone and describe go out together. If describe shows our
+    middleware of the same version, we're done, otherwise it is uploaded
+    with load-file and installed with add-middleware"""
     if 1 == msg.get("id") and "new-session" in msg:
         conn.session = msg["new-session"]
-        with open(os.path.join(sublime.packages_path(), "sublime-clojure-repl", "src", "middleware.clj"), "r") as file:
-            conn.send({"op": "load-file",
-                       "session": conn.session,
-                       "file": file.read(),
-                       "id": 2})
-        conn.set_status("🌓 Uploading middlewares")
-        return True
+
+    elif 4 == msg.get("id") and "done" in msg.get("status", []):
+        _, version = middleware()
+        conn.middleware_installed = version == msg.get("aux", {}).get(ns + ".middleware/version")
 
     elif 2 == msg.get("id") and msg.get("status") == ["done"]:
         conn.send({"op":               "add-middleware",
                    "middleware":       ["sublime-clojure-repl.middleware/wrap-errors",
-                                        "sublime-clojure-repl.middleware/wrap-output"],
+                                        "sublime-clojure-repl.middleware/wrap-output",
+                                        "sublime-clojure-repl.middleware/wrap-values",
+                                        "sublime-clojure-repl.middleware/wrap-vars"],
                    "extra-namespaces": ["sublime-clojure-repl.middleware"],
                    "session":          conn.session,
-                   "id":               3})
+                   "id":               3}, handle_connect)
         conn.set_status("🌔 Adding middlewares")
         return True
 
     elif 3 == msg.get("id") and msg.get("status") == ["done"]:
-        conn.set_status(f"🌕 {conn.host}:{conn.port}")
+        connected(conn)
         return True
 
-def handle_done(msg):
-    if "id" in msg and msg["id"] in conn.evals and "status" in msg and "done" in msg["status"]:
-        eval = conn.evals[msg["id"]]
-        if eval.status not in {"success", "exception"}:
-            conn.erase_eval(eval)
+    if msg.get("id") in {1, 4} and conn.session and conn.middleware_installed != None:
+        if conn.middleware_installed:
+            connected(conn)
+        else:
+            source, _ = middleware()
+            conn.send({"op": "load-file",
+                       "session": conn.session,
+                       "file": source,
+                       "id": 2}, handle_connect)
+            conn.set_status("🌓 Uploading middlewares")
+        return True
 
-def handle_msg(msg):
-    print("<<<", msg)
-
-    for key in msg.get('nrepl.middleware.print/truncated-keys', []):
-        msg[key] += '...'
-
-    handle_connect(msg) \
-    or handle_new_session(msg) \
-    or handle_value(msg) \
-    or handle_exception(msg) \
-    or handle_lookup(msg) \
-    or handle_done(msg)
-
-def read_loop():
-    try:
-        conn.pending_id = 1
-        conn.send({"op": "clone", "id": conn.pending_id})
-        conn.set_status(f"🌒 Cloning session")
-        for msg in bencode.decode_file(SocketIO(conn.socket)):
-            handle_msg(msg)
-    except OSError:
-        pass
-    conn.disconnect()
-
-def connect(host, port):
-    conn.host = host
-    conn.port = port
-    try:
-        conn.socket = socket.create_connection((host, port))
-        conn.reader = threading.Thread(daemon=True, target=read_loop)
-        conn.reader.start()
-    except Exception as e:
-        print(e)
-        conn.socket = None
-        conn.set_status(f"🌑 {host}:{port}")
+def connected(conn):
+    conn.set_status(f"🌕 {conn.host}:{conn.port}")
+    conn.attempts = 0
+    conn.pool.fill()
+    conn.symbols.refresh()
+    sublime.status_message(f"Connected to {conn.name()} in {int((time.time() - conn.opened) * 1000)} ms")
+
+def handle_msg(conn, msg):
+    if config.debug:
+        print("<<<", msg)
+
+    # may arrive after "done", e.g. printed from a future
+    for key in ("out", "err"):
+        if key in msg:
+            conn.output.append(msg[key])
+
+    request = conn.pending.get(msg.get("id"))
+    if request:
+        for key in msg.get('nrepl.middleware.print/truncated-keys', []):
+            msg[key] += '...'
+
+        # before calling handler, it might reuse the id (clone -> eval)
+        if "done" in msg.get("status", []):
+            conn.pool.release(request.id)
+            conn.pending.pop(request.id, None) # gone if disconnected meanwhile
+
+        request.handler(conn, msg)
+
+def connect(host, port, window = None, retry = False):
+    """Opens a new connection unless there's one already. With retry, keeps
+    trying if the server is not up yet"""
+    conn = conns.find(host, port)
+    if conn:
+        if window:
+            conns.route(window, conn)
+        return
+    conn = Connection(host, port)
+    conns.add(conn, window)
+    def failed():
+        if retry:
+            conn.schedule_reconnect()
+        else:
+            conns.remove(conn)
+            conns.offline_status = f"🌑 {host}:{port}"
+            ui.schedule("status", conns.refresh_status)
+    conn.open(failed)
+    conn.watch()
 
 class HostPortInputHandler(sublime_plugin.TextInputHandler):
     def placeholder(self):
         return "host:port"
 
     def initial_text(self):
-        if conn.host and conn.port:
+        conn = conns.for_window(sublime.active_window())
+        if conn:
             return f'{conn.host}:{conn.port}'
 
     def preview(self, text):
@@ -502,33 +1785,78 @@ class ConnectCommand(sublime_plugin.ApplicationCommand):
     def run(self, host_port):
         host, port = host_port.strip().split(':')
         port = int(port)
-        connect(host, port)
+        connect(host, port, sublime.active_window())
 
     def input(self, args):
         return HostPortInputHandler()
 
-    def is_enabled(self):
-        return conn.socket == None
-
 class DisconnectCommand(sublime_plugin.ApplicationCommand):
     def run(self):
-        conn.disconnect()
+        conns.for_window(sublime.active_window()).disconnect()
 
     def is_enabled(self):
-        return conn.socket != None
+        return conns.for_window(sublime.active_window()) != None
 
 class ReconnectCommand(sublime_plugin.ApplicationCommand):
     def run(self):
+        window = sublime.active_window()
+        conn = conns.for_window(window)
         conn.disconnect()
-        connect(conn.host, conn.port)
+        connect(conn.host, conn.port, window)
 
     def is_enabled(self):
-        return conn.socket != None
+        return conns.for_window(sublime.active_window()) != None
 
-def plugin_loaded():
-    connect('localhost', 5555) # FIXME
+class SwitchConnectionCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        window = self.window
+        items = [conn.name() for conn in conns.conns]
+        def on_done(idx):
+            if idx >= 0:
+                conns.route(window, conns.conns[idx])
+        current = conns.for_window(window)
+        window.show_quick_panel(items, on_done, selected_index = conns.conns.index(current) if current else -1)
 
-def plugin_unloaded():
-    conn.disconnect()
+    def is_enabled(self):
+        return len(conns.conns) > 1
+
+class ShowConnectionStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        report = conns.for_window(self.window).stats.report()
+        report += f"\n\nUI: {ui.flushes} flushes, {ui.coalesced} coalesced updates, {ui.busy * 1000:.1f} ms rendering\n"
+        view = self.window.new_file()
+        view.set_name("Clojure REPL Stats")
+        view.set_scratch(True)
+        view.run_command("append", {"characters": report})
+
+    def is_enabled(self):
+        return conns.for_window(self.window) != None
 
+class ShowOutputCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        output = conns.for_window(self.window).output
+        name = output.panel_name()
+        if not self.window.find_output_panel(name):
+            self.window.create_output_panel(name)
+        output.flush()
+        self.window.run_command("show_panel", {"panel": "output." + name})
+
+    def is_enabled(self):
+        return conns.for_window(self.window) != None
 
+def plugin_loaded():
+    settings().add_on_change(ns, config.reload)
+    sublime.load_settings("Preferences.sublime-settings").add_on_change(ns, config.reload)
+    config.reload()
+    host_port = settings().get("auto_connect")
+    if host_port:
+        host, port = host_port.strip().split(':')
+        connect(host, int(port), retry = True)
+
+def plugin_unloaded():
+    settings().clear_on_change(ns)
+    for file in trace_files.values():
+        file.close()
+    sublime.load_settings("Preferences.sublime-settings").clear_on_change(ns)
+    conns.disconnect_all()
+    loop.stop()
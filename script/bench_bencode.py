@@ -0,0 +1,172 @@
+#! /usr/bin/env python3
+'''
+  Benchmarks and fuzzes src/bencode.py offline.
+
+    script/bench_bencode.py bench [--transcript FILE] [--chunks 64,4096,65536]
+    script/bench_bencode.py fuzz [--iterations 10000] [--seed 42]
+
+  bench replays nREPL transcripts through every encoder and decoder and
+  prints msgs/sec, MB/s and peak allocated memory. Built-in transcripts
+  mimic typical traffic; --transcript replays raw bencode bytes captured
+  from a real connection instead.
+
+  fuzz round-trips random values through encode/encode_bytes and every
+  decoder, feeding BencodeDecoder at random split points, and stops at
+  the first mismatch.
+'''
+
+import argparse, io, os, random, sys, time, tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import bencode
+
+
+def small_evals(n = 2000):
+  msgs = []
+  for id in range(n):
+    session = '8a1f8e0c-3c1b-4c1e-9c55-2b8f1d8f5e%02d' % (id % 100)
+    msgs.append({'id': id, 'session': session, 'ns': 'user', 'value': str(id * 7)})
+    msgs.append({'id': id, 'session': session, 'status': ['done']})
+  return msgs
+
+def huge_values(n = 10, size = 1024 * 1024):
+  value = '(' + ' '.join(str(i) for i in range(size // 7)) + ')'
+  return [{'id': id, 'session': 's', 'ns': 'user', 'value': value[:size]} for id in range(n)]
+
+def nested_infos(n = 500, depth = 6):
+  def info(d):
+    if d == 0:
+      return {'name': 'join', 'ns': 'clojure.string', 'arglists-str': '([coll] [separator coll])'}
+    return {'doc': 'Returns a string of all elements in coll' * 3,
+            'see-also': ['clojure.core/str', 'clojure.string/split'],
+            'child': info(d - 1),
+            'line': d * 11}
+  return [{'id': id, 'session': 's', 'info': info(depth), 'status': ['done']} for id in range(n)]
+
+def unicode_output(n = 2000):
+  line = 'Привет, 世界! λ → ∀x∈ℝ 🙂🚀 ' * 4 + '\n'
+  return [{'id': id, 'session': 's', 'out': line} for id in range(n)]
+
+TRANSCRIPTS = {
+  'small evals':    small_evals,
+  'huge values':    huge_values,
+  'nested infos':   nested_infos,
+  'unicode output': unicode_output,
+}
+
+def load_transcript(path):
+  with open(path, 'rb') as file:
+    data = file.read()
+  return bencode.BencodeDecoder().feed(data)
+
+
+def decode_file(data, chunk):
+  return list(bencode.decode_file(io.BytesIO(data)))
+
+def decode_buffer(data, chunk):
+  msgs = []
+  pos = 0
+  while pos < len(data):
+    msg, pos = bencode.decode_buffer(data, pos)
+    msgs.append(msg)
+  return msgs
+
+def decoder_feed(data, chunk):
+  decoder = bencode.BencodeDecoder()
+  msgs = []
+  for pos in range(0, len(data), chunk):
+    msgs += decoder.feed(data[pos:pos + chunk])
+  return msgs
+
+def encode_str(msgs):
+  return [bencode.encode(msg).encode('utf-8') for msg in msgs]
+
+def encode_bytes(msgs):
+  return [bencode.encode_bytes(msg) for msg in msgs]
+
+
+def measure(fn, *args, repeat = 3):
+  "(best seconds, peak bytes) of fn(*args)"
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  tracemalloc.start()
+  fn(*args)
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return best, peak
+
+def report(name, count, size, seconds, peak):
+  print('  %-28s %10.0f msgs/s %8.1f MB/s %10.1f KB peak' %
+        (name, count / seconds, size / seconds / 1024 / 1024, peak / 1024))
+
+def bench(args):
+  if args.transcript:
+    transcripts = {os.path.basename(args.transcript): load_transcript(args.transcript)}
+  else:
+    transcripts = {name: gen() for name, gen in TRANSCRIPTS.items()}
+  chunks = [int(c) for c in args.chunks.split(',')]
+  for name, msgs in transcripts.items():
+    data = b''.join(bencode.encode_bytes(msg) for msg in msgs)
+    print('%s: %d msgs, %.1f KB' % (name, len(msgs), len(data) / 1024))
+    for label, fn in [('encode', encode_str), ('encode_bytes', encode_bytes)]:
+      report(label, len(msgs), len(data), *measure(fn, msgs, repeat = args.repeat))
+    report('decode_file', len(msgs), len(data), *measure(decode_file, data, 0, repeat = args.repeat))
+    report('decode_buffer', len(msgs), len(data), *measure(decode_buffer, data, 0, repeat = args.repeat))
+    for chunk in chunks:
+      report('BencodeDecoder.feed/%d' % chunk, len(msgs), len(data), *measure(decoder_feed, data, chunk, repeat = args.repeat))
+
+
+ALPHABET = 'abcxyz019 :ie-/\n\t"\\é世🙂'
+
+def random_string(rnd):
+  return ''.join(rnd.choice(ALPHABET) for _ in range(rnd.choice([0, 1, 2, 5, 20, 300])))
+
+def random_value(rnd, depth = 0):
+  kind = rnd.randrange(4 if depth < 4 else 2)
+  if kind == 0:
+    return rnd.choice([0, 1, -1, 7, -12345, 2 ** 40, -(2 ** 70), rnd.randrange(-10 ** 6, 10 ** 6)])
+  elif kind == 1:
+    return random_string(rnd)
+  elif kind == 2:
+    return [random_value(rnd, depth + 1) for _ in range(rnd.randrange(5))]
+  else:
+    return {random_string(rnd): random_value(rnd, depth + 1) for _ in range(rnd.randrange(5))}
+
+def fuzz(args):
+  rnd = random.Random(args.seed)
+  for i in range(args.iterations):
+    values = [random_value(rnd) for _ in range(rnd.randrange(1, 4))]
+    data = b''.join(bencode.encode_bytes(v) for v in values)
+    checks = {
+      'encode':        b''.join(bencode.encode(v).encode('utf-8') for v in values) == data,
+      'decode_file':   decode_file(data, 0) == values,
+      'decode_buffer': decode_buffer(data, 0) == values,
+    }
+    cuts = sorted(rnd.sample(range(len(data) + 1), min(len(data) + 1, rnd.randrange(1, 8))))
+    decoder = bencode.BencodeDecoder()
+    decoded = []
+    for a, b in zip([0] + cuts, cuts + [len(data)]):
+      decoded += decoder.feed(data[a:b])
+    checks['BencodeDecoder.feed'] = decoded == values and not decoder.pending()
+    failed = [name for name, ok in checks.items() if not ok]
+    if failed:
+      print('Iteration %d, seed %d: %s failed for %r' % (i, args.seed, ', '.join(failed), values))
+      sys.exit(1)
+  print('%d iterations OK' % args.iterations)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'Benchmark and fuzz src/bencode.py')
+  commands = parser.add_subparsers(dest = 'command', required = True)
+  bench_parser = commands.add_parser('bench')
+  bench_parser.add_argument('--transcript', help = 'file with raw bencode bytes to replay')
+  bench_parser.add_argument('--chunks', default = '64,4096,65536', help = 'recv sizes for BencodeDecoder.feed')
+  bench_parser.add_argument('--repeat', type = int, default = 3)
+  fuzz_parser = commands.add_parser('fuzz')
+  fuzz_parser.add_argument('--iterations', type = int, default = 10000)
+  fuzz_parser.add_argument('--seed', type = int, default = 42)
+  args = parser.parse_args()
+  bench(args) if args.command == 'bench' else fuzz(args)
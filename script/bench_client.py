@@ -0,0 +1,208 @@
+#! /usr/bin/env python3
+'''
+  Measures eval round trips through the plugin's own client code (Connection,
+  Loop, handle_msg, Eval) against script/fake_nrepl.py, with the Sublime API
+  replaced by a minimal in-memory stub.
+
+    script/bench_client.py --evals 2000 --concurrency 1 --latency 0
+
+  Reports p50/p99/max latency from sending an eval until its value is
+  handled on the loop thread, and until it is drawn on the (stub) UI
+  thread, plus evals/sec.
+'''
+
+import argparse, importlib.util, os, sys, tempfile, threading, time, types
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_nrepl
+
+
+def stub_sublime(packages_path):
+  "Just enough of sublime and sublime_plugin to connect and eval"
+  sublime = types.ModuleType('sublime')
+  sublime_plugin = types.ModuleType('sublime_plugin')
+
+  class Region:
+    def __init__(self, a, b = None):
+      self.a = a
+      self.b = a if b is None else b
+    def begin(self): return min(self.a, self.b)
+    def end(self): return max(self.a, self.b)
+    def empty(self): return self.a == self.b
+    def intersects(self, other): return self.begin() < other.end() and other.begin() < self.end()
+
+  class Settings(dict):
+    def get(self, key, default = None): return dict.get(self, key, default)
+    def set(self, key, value): self[key] = value
+    def add_on_change(self, key, callback): pass
+    def clear_on_change(self, key): pass
+
+  class View:
+    ids = iter(range(1, 1 << 30))
+    def __init__(self, text, window = None):
+      self._id = next(View.ids)
+      self.text = text
+      self._window = window
+      self.regions = {}
+      self._settings = Settings()
+    def id(self): return self._id
+    def buffer_id(self): return self._id
+    def window(self): return self._window
+    def file_name(self): return None
+    def size(self): return len(self.text)
+    def change_count(self): return 0
+    def settings(self): return self._settings
+    def substr(self, region): return self.text[region.begin():region.end()]
+    def line(self, region):
+      point = region.begin() if isinstance(region, Region) else region
+      begin = self.text.rfind('\n', 0, point) + 1
+      end = self.text.find('\n', point)
+      return Region(begin, len(self.text) if end < 0 else end)
+    def rowcol_utf16(self, point):
+      return self.text.count('\n', 0, point), point - self.text.rfind('\n', 0, point) - 1
+    def add_regions(self, key, regions, *args, **kwargs): self.regions[key] = list(regions)
+    def get_regions(self, key): return self.regions.get(key, [])
+    def erase_regions(self, key): self.regions.pop(key, None)
+
+  class Window:
+    def id(self): return 1
+    def active_view(self): return None
+
+  timeouts = []
+  timeouts_lock = threading.Lock()
+
+  def set_timeout(callback, delay = 0):
+    with timeouts_lock:
+      timeouts.append((time.time() + delay / 1000, callback))
+
+  def run_timeouts():
+    "Runs callbacks that are due, like Sublime's main thread would"
+    now = time.time()
+    with timeouts_lock:
+      due = [t for t in timeouts if t[0] <= now]
+      timeouts[:] = [t for t in timeouts if t[0] > now]
+    for _, callback in due:
+      callback()
+
+  settings = {}
+  sublime.Region = Region
+  sublime.View = View
+  sublime.Window = Window
+  sublime.DRAW_NO_FILL = 32
+  sublime.LAYOUT_BLOCK = 2
+  sublime.HOVER_TEXT = 1
+  sublime.HIDE_ON_MOUSE_MOVE_AWAY = 2
+  sublime.set_timeout = set_timeout
+  sublime.run_timeouts = run_timeouts
+  sublime.load_settings = lambda name: settings.setdefault(name, Settings())
+  sublime.packages_path = lambda: packages_path
+  sublime.active_window = lambda: None
+  sublime.windows = lambda: []
+  sublime.status_message = lambda msg: None
+
+  class Command:
+    def __init__(self, *args): pass
+  for name in ['EventListener', 'TextCommand', 'WindowCommand', 'ApplicationCommand',
+               'TextChangeListener', 'TextInputHandler', 'ListInputHandler']:
+    setattr(sublime_plugin, name, type(name, (Command,), {}))
+
+  sys.modules['sublime'] = sublime
+  sys.modules['sublime_plugin'] = sublime_plugin
+  return sublime
+
+def load_plugin():
+  "Imports package.py as a submodule, so its relative imports work"
+  package = types.ModuleType('sublime_clojure_repl')
+  package.__path__ = [root]
+  sys.modules['sublime_clojure_repl'] = package
+  spec = importlib.util.spec_from_file_location('sublime_clojure_repl.package', os.path.join(root, 'package.py'))
+  plugin = importlib.util.module_from_spec(spec)
+  sys.modules[spec.name] = plugin
+  spec.loader.exec_module(plugin)
+  return plugin
+
+
+def percentile(xs, p):
+  xs = sorted(xs)
+  return xs[min(len(xs) - 1, int(len(xs) * p))]
+
+def wait(sublime, cond, timeout = 10):
+  deadline = time.time() + timeout
+  while not cond():
+    if time.time() > deadline:
+      raise TimeoutError()
+    sublime.run_timeouts()
+    time.sleep(0.0002)
+
+def main(args):
+  packages = tempfile.mkdtemp()
+  os.symlink(os.path.abspath(root), os.path.join(packages, 'sublime-clojure-repl'))
+  sublime = stub_sublime(packages)
+  plugin = load_plugin()
+  plugin.config.ui_update_interval = args.ui_update_interval
+
+  server = fake_nrepl.FakeNrepl(latency = args.latency, value_size = args.value_size,
+                                out_chunks = args.out_chunks).start()
+  window = sublime.Window()
+  plugin.connect('127.0.0.1', server.port, window)
+  conn = plugin.conns.for_window(window)
+  wait(sublime, lambda: conn.ready() and len(conn.pool.idle) > 0)
+
+  sent = {}
+  handled = {}
+  drawn = {}
+  handle_value = plugin.handle_value
+  def timed_handle_value(conn, eval, msg):
+    handled[eval.id] = time.perf_counter()
+    return handle_value(conn, eval, msg)
+  plugin.handle_value = timed_handle_value
+
+  lines = ['(+ %d 1)' % i for i in range(args.concurrency)]
+  view = sublime.View('(ns bench)\n' + '\n'.join(lines) + '\n', window)
+  regions, pos = [], len('(ns bench)\n')
+  for line in lines:
+    regions.append(sublime.Region(pos, pos + len(line)))
+    pos += len(line) + 1
+
+  start = time.perf_counter()
+  for round in range(args.evals // args.concurrency):
+    evals = []
+    for region in regions:
+      before = set(conn.evals)
+      t = time.perf_counter()
+      plugin.eval(conn, view, region)
+      for id in set(conn.evals) - before:
+        sent[id] = t
+        evals.append(conn.evals[id])
+    def done():
+      for eval in evals:
+        if eval.id not in drawn and eval.status == 'success' and view.get_regions(eval.value_key()):
+          drawn[eval.id] = time.perf_counter()
+      return all(eval.id in drawn for eval in evals)
+    wait(sublime, done)
+  elapsed = time.perf_counter() - start
+
+  to_handled = [(handled[id] - sent[id]) * 1000 for id in sent if id in handled]
+  to_drawn = [(drawn[id] - sent[id]) * 1000 for id in sent if id in drawn]
+  print('%d evals, concurrency %d, server latency %g ms, ui_update_interval %d ms' %
+        (len(sent), args.concurrency, args.latency * 1000, args.ui_update_interval))
+  for name, xs in [('value handled', to_handled), ('value drawn', to_drawn)]:
+    print('  %-14s p50 %7.2f ms   p99 %7.2f ms   max %7.2f ms' %
+          (name, percentile(xs, 0.5), percentile(xs, 0.99), max(xs)))
+  print('  %.0f evals/sec, %d messages received by server' % (len(sent) / elapsed, server.received))
+  plugin.conns.disconnect_all()
+  plugin.loop.stop()
+  server.close()
+  os.remove(os.path.join(packages, 'sublime-clojure-repl'))
+  os.rmdir(packages)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'Benchmark eval round trips against a fake nREPL server')
+  parser.add_argument('--evals', type = int, default = 2000)
+  parser.add_argument('--concurrency', type = int, default = 1, help = 'evals in flight at once')
+  parser.add_argument('--latency', type = float, default = 0.0, help = 'seconds the server spends per eval')
+  parser.add_argument('--value-size', type = int, default = 0)
+  parser.add_argument('--out-chunks', type = int, default = 0)
+  parser.add_argument('--ui-update-interval', type = int, default = 0, help = 'overrides ui_update_interval setting')
+  main(parser.parse_args())
@@ -0,0 +1,173 @@
+#! /usr/bin/env python3
+'''
+  In-process stand-in for an nREPL server, for benchmarks that shouldn't
+  wait for a JVM. Speaks bencode over TCP and implements clone, close,
+  describe, eval, load-file, lookup, interrupt and add-middleware.
+
+  Evals don't evaluate anything: each one waits `latency` seconds, streams
+  `out_chunks` chunks of `out_size` characters and replies with a value of
+  `value_size` characters (or echoes the code if 0). Code containing
+  "throw" replies with an exception instead. Messages of one session are
+  processed in order, like in nREPL.
+
+    script/fake_nrepl.py --port 5555 --latency 0.01 --out-chunks 3
+'''
+
+import argparse, os, queue, socket, sys, threading, time, uuid
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import bencode
+
+
+class Session:
+  def __init__(self, server, send, id):
+    self.server = server
+    self.send = send
+    self.id = id
+    self.queue = queue.Queue()
+    self.current = None
+    self.interrupted = threading.Event()
+    threading.Thread(daemon = True, target = self.run).start()
+
+  def run(self):
+    while True:
+      msg = self.queue.get()
+      if msg is None:
+        return
+      self.current = msg['id']
+      self.interrupted.clear()
+      self.server.eval(self, msg)
+      self.current = None
+
+
+class FakeNrepl:
+  def __init__(self, host = '127.0.0.1', port = 0, latency = 0.0, value_size = 0, out_chunks = 0, out_size = 80):
+    self.latency = latency
+    self.value_size = value_size
+    self.out_chunks = out_chunks
+    self.out_size = out_size
+    self.sock = socket.socket()
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind((host, port))
+    self.sock.listen()
+    self.port = self.sock.getsockname()[1]
+    self.clients = []
+    self.received = 0
+
+  def start(self):
+    threading.Thread(daemon = True, target = self.accept).start()
+    return self
+
+  def close(self):
+    self.sock.close()
+    for client in self.clients:
+      try:
+        client.shutdown(socket.SHUT_RDWR)
+        client.close()
+      except OSError:
+        pass
+
+  def accept(self):
+    while True:
+      try:
+        client, _ = self.sock.accept()
+      except OSError:
+        return
+      client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      self.clients.append(client)
+      threading.Thread(daemon = True, target = self.serve, args = (client,)).start()
+
+  def serve(self, client):
+    sessions = {}
+    decoder = bencode.BencodeDecoder()
+    lock = threading.Lock()
+    def send(msg):
+      with lock:
+        try:
+          client.sendall(bencode.encode_bytes(msg))
+        except OSError:
+          pass
+    while True:
+      try:
+        data = client.recv(65536)
+      except OSError:
+        break
+      if not data:
+        break
+      for msg in decoder.feed(data):
+        self.received += 1
+        self.handle(send, sessions, msg)
+    for session in sessions.values():
+      session.queue.put(None)
+    client.close()
+
+  def handle(self, send, sessions, msg):
+    op = msg.get('op')
+    id = msg.get('id')
+    reply = lambda **kw: send({'id': id, **({'session': msg['session']} if 'session' in msg else {}), **kw})
+    if op == 'clone':
+      session = Session(self, send, str(uuid.uuid4()))
+      sessions[session.id] = session
+      reply(**{'new-session': session.id, 'status': ['done']})
+    elif op == 'close':
+      session = sessions.pop(msg.get('session'), None)
+      if session:
+        session.queue.put(None)
+      reply(status = ['session-closed', 'done'])
+    elif op == 'describe':
+      reply(ops = {op: {} for op in ['clone', 'close', 'describe', 'eval', 'load-file', 'lookup', 'interrupt', 'add-middleware']},
+            versions = {'nrepl': {'version-string': 'fake'}},
+            aux = {},
+            status = ['done'])
+    elif op in ('eval', 'load-file'):
+      session = sessions.get(msg.get('session'))
+      if session:
+        session.queue.put(msg)
+      else:
+        reply(status = ['error', 'unknown-session', 'done'])
+    elif op == 'interrupt':
+      session = sessions.get(msg.get('session'))
+      if session and session.current is not None and msg.get('interrupt-id') in (None, session.current):
+        session.interrupted.set()
+        reply(status = ['done'])
+      else:
+        reply(status = ['session-idle', 'done'])
+    elif op == 'lookup':
+      reply(info = {'ns': 'clojure.core', 'name': msg.get('sym', ''), 'arglists-str': '([x])', 'doc': 'Fake doc'},
+            status = ['done'])
+    elif op == 'add-middleware':
+      reply(status = ['done'])
+    else:
+      reply(status = ['error', 'unknown-op', 'done'])
+
+  def eval(self, session, msg):
+    reply = lambda **kw: session.send({'id': msg['id'], 'session': session.id, **kw})
+    if session.interrupted.wait(self.latency):
+      reply(status = ['interrupted', 'done'])
+      return
+    for _ in range(self.out_chunks):
+      reply(out = 'o' * (self.out_size - 1) + '\n')
+    code = msg.get('code') or msg.get('file') or ''
+    if 'throw' in code:
+      reply(ex = 'class clojure.lang.ExceptionInfo', **{'root-ex': 'class clojure.lang.ExceptionInfo'}, status = ['eval-error'])
+      reply(err = 'Execution error (ExceptionInfo) at user/eval1 (REPL:1).\n')
+    else:
+      reply(ns = msg.get('ns', 'user'), value = 'v' * self.value_size if self.value_size else code)
+    reply(status = ['done'])
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'Fake nREPL server')
+  parser.add_argument('--port', type = int, default = 5555)
+  parser.add_argument('--latency', type = float, default = 0.0, help = 'seconds every eval takes')
+  parser.add_argument('--value-size', type = int, default = 0, help = 'characters in every value, 0 to echo code')
+  parser.add_argument('--out-chunks', type = int, default = 0, help = 'out messages before every value')
+  parser.add_argument('--out-size', type = int, default = 80)
+  args = parser.parse_args()
+  server = FakeNrepl(port = args.port, latency = args.latency, value_size = args.value_size,
+                     out_chunks = args.out_chunks, out_size = args.out_size).start()
+  print('Fake nREPL server started on port %d' % server.port)
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.close()
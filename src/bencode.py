@@ -81,6 +81,141 @@ def _read_datum(s):
         return _read_fns.get(delim, lambda s: _read_bytes(s, delim))(s)
 
 
+class Incomplete(Exception):
+    "Raised when the buffer ends in the middle of a datum."
+    pass
+
+
+def _decode_at(buf, view, pos):
+    if pos >= len(buf):
+        raise Incomplete()
+    c = buf[pos]
+    if c == 0x69: # i
+        end = buf.find(b"e", pos + 1)
+        if end < 0:
+            raise Incomplete()
+        return int(buf[pos + 1:end]), end + 1
+    elif c == 0x6C or c == 0x64: # l, d
+        data = []
+        pos += 1
+        while True:
+            if pos >= len(buf):
+                raise Incomplete()
+            if buf[pos] == 0x65: # e
+                break
+            datum, pos = _decode_at(buf, view, pos)
+            data.append(datum)
+        if c == 0x64:
+            i = iter(data)
+            data = dict(zip(i, i))
+        return data, pos + 1
+    else:
+        colon = buf.find(b":", pos)
+        if colon < 0:
+            raise Incomplete()
+        end = colon + 1 + int(buf[pos:colon])
+        if end > len(buf):
+            raise Incomplete()
+        return str(view[colon + 1:end], "UTF-8"), end
+
+
+def decode_buffer(buf, pos=0):
+    """Decodes a single datum from a bytes-like object starting at pos.
+    Returns (value, end). Raises Incomplete if buf ends before the datum does."""
+    with memoryview(buf) as view:
+        return _decode_at(buf, view, pos)
+
+
+class BencodeDecoder(object):
+    """Resumable push parser. Feed it chunks split at arbitrary boundaries,
+    get back the top-level values completed so far:
+
+        decoder = BencodeDecoder()
+        for msg in decoder.feed(socket.recv(65536)):
+            ...
+
+    Nothing is re-parsed between calls: open lists/dicts are kept on a stack
+    and a string whose length prefix has been read waits until all of its
+    bytes arrived before being decoded."""
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._stack = [] # [(is_dict, items)]
+        self._strlen = None
+
+    def _complete(self, value, out):
+        if self._stack:
+            self._stack[-1][1].append(value)
+        else:
+            out.append(value)
+
+    def feed(self, data):
+        buf = self._buf
+        buf += data
+        pos = 0
+        out = []
+        try:
+            while True:
+                if self._strlen is not None:
+                    end = pos + self._strlen
+                    if end > len(buf):
+                        break
+                    with memoryview(buf) as view:
+                        value = str(view[pos:end], "UTF-8")
+                    pos = end
+                    self._strlen = None
+                    self._complete(value, out)
+                    continue
+                if pos >= len(buf):
+                    break
+                c = buf[pos]
+                if c == 0x69: # i
+                    end = buf.find(b"e", pos + 1)
+                    if end < 0:
+                        break
+                    value = int(buf[pos + 1:end])
+                    pos = end + 1
+                    self._complete(value, out)
+                elif c == 0x6C or c == 0x64: # l, d
+                    self._stack.append((c == 0x64, []))
+                    pos += 1
+                elif c == 0x65: # e
+                    if not self._stack:
+                        raise ValueError("Unexpected 'e' at top level")
+                    is_dict, value = self._stack.pop()
+                    if is_dict:
+                        i = iter(value)
+                        value = dict(zip(i, i))
+                    pos += 1
+                    self._complete(value, out)
+                elif 0x30 <= c <= 0x39: # 0-9
+                    colon = buf.find(b":", pos)
+                    if colon < 0:
+                        break
+                    self._strlen = int(buf[pos:colon])
+                    pos = colon + 1
+                else:
+                    raise ValueError("Unexpected byte %r at %d" % (chr(c), pos))
+        finally:
+            del buf[:pos]
+        return out
+
+    def pending(self):
+        "True if the decoder is in the middle of a value."
+        return bool(self._buf) or bool(self._stack) or self._strlen is not None
+
+
+def decode_socket(socket, bufsize=65536):
+    "Generator that yields values read from a blocking socket until it is closed."
+    decoder = BencodeDecoder()
+    while True:
+        chunk = socket.recv(bufsize)
+        if not chunk:
+            break
+        for value in decoder.feed(chunk):
+            yield value
+
+
 def _write_datum(x, out):
     if isinstance(x, (str, bytes)):
         # x = x.encode("UTF-8")
@@ -107,6 +242,45 @@ def _write_datum(x, out):
     out.flush()
 
 
+def _encode_datum(x, chunks):
+    if isinstance(x, str):
+        x = x.encode("UTF-8")
+        chunks.append(b"%d:" % len(x))
+        chunks.append(x)
+    elif isinstance(x, bytes):
+        chunks.append(b"%d:" % len(x))
+        chunks.append(x)
+    elif isinstance(x, numbers.Integral):
+        chunks.append(b"i%de" % x)
+    elif isinstance(x, dict):
+        chunks.append(b"d")
+        for k, v in x.items():
+            _encode_datum(k, chunks)
+            _encode_datum(v, chunks)
+        chunks.append(b"e")
+    elif isinstance(x, (list, tuple)):
+        chunks.append(b"l")
+        for v in x:
+            _encode_datum(v, chunks)
+        chunks.append(b"e")
+    else:
+        # dropping it would leave a dict with an odd number of items on the wire
+        raise TypeError("Can't bencode %r" % (x,))
+
+
+def encode_chunks(v):
+    """bencodes the given value into a list of bytes chunks, suitable for
+    socket.sendmsg. Every string is encoded to UTF-8 exactly once."""
+    chunks = []
+    _encode_datum(v, chunks)
+    return chunks
+
+
+def encode_bytes(v):
+    "bencodes the given value straight to bytes."
+    return b"".join(encode_chunks(v))
+
+
 def encode(v):
     "bencodes the given value, may be a string, integer, list, or dict."
     s = BytesIO()
@@ -172,11 +346,11 @@ if __name__ == '__main__':
     conn = socket.create_connection(("localhost", 5555))
 
     def read_loop(conn):
+        decoder = BencodeDecoder()
         while msg := conn.recv(4096):
-            # print("RCV RAW", msg.decode())
-            payload = msg.decode()
-            parsed = next(decode(payload))
-            print("RCV", json.dumps(parsed))
+            # print("RCV RAW", msg)
+            for parsed in decoder.feed(msg):
+                print("RCV", json.dumps(parsed))
     threading.Thread(daemon=True, target=read_loop, args=(conn,)).start()
 
     for line in sys.stdin:
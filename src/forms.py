@@ -0,0 +1,241 @@
+'''
+    Top-level form boundaries of Clojure source.
+
+    A top-level form is a maximal run of text at bracket depth 0 that is not
+    whitespace, commas or a line comment, e.g. `(+ 1 2)`, `*ns*`, but also
+    `(+ 1 2)(+ 3 4)`. Reader prefixes (`'`, `@`, `#'`, `#_`, `#inst`, `^meta`...)
+    stick to the datum they apply to across whitespace and comments, so
+    `#inst "..."` and `^:m sym` are single forms. Line comments are kept as
+    separate entries, so the gaps between entries are whitespace only. Forms
+    starting with `(ns ` are marked, so namespace lookups don't need to
+    reparse anything.
+'''
+
+import bisect, re
+
+FORM = 0
+COMMENT = 1
+NS = 2
+
+_token = re.compile(r'''
+    (?P<ws>[\s,]+)
+  | (?P<comment>;[^\n]*)
+  | (?P<string>"(?:[^"\\]|\\.)*"?)
+  | (?P<char>\\.)
+  | (?P<open>[(\[{])
+  | (?P<close>[)\]}])
+  | (?P<other>[^\s,;()\[\]{}"\\]+)
+''', re.X | re.S)
+
+_ns = re.compile(r'\([\s,]*ns[\s,]')
+_prefix = re.compile(r"\^|#_|#\?@|#\?|#'|#(?=[\"(\[{]|$)|'|@|`|~@|~")
+_symbol = re.compile(r'[^\s,;()\[\]{}"\\^@~`\']+')
+
+
+def _needs(token, need):
+    """Datums still awaited after an `other` token at depth 0, given `need`
+    awaited before it. Prefixes add to it, a datum completes one"""
+    pos = 0
+    while pos < len(token):
+        m = _prefix.match(token, pos)
+        if m:
+            need += 2 if m.group() == "^" else 1 # ^ awaits meta and target
+            pos = m.end()
+        elif token.startswith("#", pos) and not token.startswith("##", pos):
+            return need + 1 # #inst, #uuid, #:ns tag the next datum
+        else:
+            break
+    return max(0, need - 1) if pos < len(token) else need
+
+
+def scan(text, pos=0, endpos=None):
+    "Generator of (begin, end, kind) for top-level entries of text[pos:endpos]"
+    if endpos is None:
+        endpos = len(text)
+    begin = None
+    depth = 0
+    need = 0 # datums awaited by reader prefixes of current form
+    for m in _token.finditer(text, pos, endpos):
+        kind = m.lastgroup
+        if depth == 0 and (kind == "ws" or kind == "comment"):
+            if begin is not None and need == 0:
+                yield begin, end, form_kind
+                begin = None
+            if kind == "comment" and begin is None:
+                yield m.start(), m.end(), COMMENT
+            continue
+        if begin is None:
+            begin = m.start()
+            form_kind = NS if kind == "open" and _ns.match(text, begin, endpos) else FORM
+        if kind == "open":
+            depth += 1
+        elif kind == "close" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                need = max(0, need - 1)
+        elif depth == 0 and kind == "other":
+            need = _needs(m.group(), need)
+        elif depth == 0:
+            need = max(0, need - 1)
+        end = m.end()
+    if begin is not None:
+        yield begin, endpos, form_kind
+
+
+def _unwrap_meta(text, begin, end):
+    "(begin, end) of the datum an entry text[begin:end] attaches ^metadata to"
+    while text.startswith("^", begin):
+        # without the ^, metadata and its target are separate entries
+        entries = [e for e in scan(text, begin + 1, end) if e[2] != COMMENT]
+        if len(entries) < 2:
+            return None
+        begin, end = entries[1][0], entries[1][1]
+    return begin, end
+
+
+def ns_name(text, pos, endpos=None):
+    """For an NS form at text[pos:endpos] returns (name_begin, name_end, name)
+    of the declared namespace, skipping ^metadata"""
+    if endpos is None:
+        endpos = len(text)
+    m = _ns.match(text, pos, endpos)
+    if m:
+        for begin, end, kind in scan(text, m.end(), endpos):
+            if kind != COMMENT:
+                datum = _unwrap_meta(text, begin, end)
+                name = datum and _symbol.match(text, datum[0], datum[1])
+                if name:
+                    return name.start(), name.end(), name.group()
+                break
+
+
+def _entry_at(begins, ends, kinds, point):
+    # end is inclusive: a cursor right after a form still points to it
+    i = bisect.bisect_right(begins, point) - 1
+    for j in (i, i - 1):
+        if 0 <= j and begins[j] <= point <= ends[j] and kinds[j] != COMMENT:
+            return begins[j], ends[j]
+
+
+def form_at(text, point, pos=0, endpos=None):
+    "Top-level form of text[pos:endpos] around point, as (begin, end)"
+    entries = list(scan(text, pos, endpos))
+    return _entry_at([e[0] for e in entries], [e[1] for e in entries], [e[2] for e in entries], point)
+
+
+class FormIndex(object):
+    """Sorted top-level entries of a buffer, kept up to date incrementally.
+
+    Report every edit with edit(a, b, length): entries touching it are
+    dropped, entries after it are shifted and the touched range is
+    remembered. The next refresh() rescans from the last untouched entry
+    until it reaches a position past the touched range that was top-level
+    whitespace before the edit too; after that nothing can change."""
+
+    def __init__(self):
+        self.version = None
+        self.reset()
+
+    def reset(self):
+        self.begins = []
+        self.ends = []
+        self.kinds = []
+        self.built = False
+        self.dirty = None # (lo, hi) in current coordinates
+        self.ns_begins = [] # begins of NS forms
+        self.ns_names = []  # [name_end, name] of NS forms
+
+    def _index_namespaces(self, text, offset, entries):
+        for begin, end, kind in entries:
+            if kind == NS:
+                name = ns_name(text, begin - offset, end - offset)
+                if name:
+                    k = bisect.bisect_left(self.ns_begins, begin)
+                    self.ns_begins.insert(k, begin)
+                    self.ns_names.insert(k, [name[1] + offset, name[2]])
+
+    def _drop_namespaces(self, lo, hi):
+        "Drops NS forms starting in [lo, hi)"
+        k = bisect.bisect_left(self.ns_begins, lo)
+        l = bisect.bisect_left(self.ns_begins, hi)
+        del self.ns_begins[k:l]
+        del self.ns_names[k:l]
+
+    def edit(self, a, b, length):
+        "Text between a and b was replaced with `length` characters"
+        if not self.built:
+            return
+        delta = length - (b - a)
+        lo, hi = a, a + length
+        # entries touching the edit are dropped, their span becomes dirty
+        i = bisect.bisect_left(self.ends, a)
+        j = bisect.bisect_right(self.begins, b, i)
+        if i < j:
+            lo = min(lo, self.begins[i])
+            if self.ends[j - 1] >= b:
+                hi = max(hi, self.ends[j - 1] + delta)
+            self._drop_namespaces(self.begins[i], self.begins[j - 1] + 1)
+        k = bisect.bisect_right(self.ns_begins, b)
+        for l in range(k, len(self.ns_begins)):
+            self.ns_begins[l] += delta
+            self.ns_names[l][0] += delta
+        self.begins[i:] = [p + delta for p in self.begins[j:]]
+        self.ends[i:] = [p + delta for p in self.ends[j:]]
+        self.kinds[i:] = self.kinds[j:]
+        if self.dirty:
+            shift = lambda p: p if p < a else (p + delta if p >= b else a)
+            lo = min(lo, shift(self.dirty[0]))
+            hi = max(hi, shift(self.dirty[1]))
+        self.dirty = (lo, hi)
+
+    def refresh(self, read):
+        "Brings index up to date. read(begin) should return text from begin to the end of buffer"
+        if not self.built:
+            text = read(0)
+            entries = list(scan(text))
+            self.begins = [e[0] for e in entries]
+            self.ends = [e[1] for e in entries]
+            self.kinds = [e[2] for e in entries]
+            self._index_namespaces(text, 0, entries)
+            self.built = True
+            self.dirty = None
+        elif self.dirty:
+            lo, hi = self.dirty
+            i = bisect.bisect_left(self.ends, lo)
+            start = self.ends[i - 1] if i > 0 else 0
+            text = read(start)
+            new = []
+            stop = None
+            for begin, end, kind in scan(text):
+                new.append((begin + start, end + start, kind))
+                end += start
+                if end >= hi:
+                    j = bisect.bisect_left(self.begins, end) - 1
+                    if j < i or self.ends[j] <= end:
+                        stop = bisect.bisect_left(self.begins, end, i)
+                        break
+            if stop is None:
+                stop = len(self.begins)
+            if i < stop:
+                self._drop_namespaces(self.begins[i], self.begins[stop - 1] + 1)
+            self._index_namespaces(text, start, new)
+            self.begins[i:stop] = [e[0] for e in new]
+            self.ends[i:stop] = [e[1] for e in new]
+            self.kinds[i:stop] = [e[2] for e in new]
+            self.dirty = None
+
+    def form_at(self, point):
+        "Top-level form containing or ending at point, as (begin, end), or None"
+        return _entry_at(self.begins, self.ends, self.kinds, point)
+
+    def forms(self):
+        "All top-level forms, as (begin, end), without comments"
+        return [(b, e) for b, e, k in zip(self.begins, self.ends, self.kinds) if k != COMMENT]
+
+    def namespace_at(self, point):
+        "Name of the last namespace declared before point, or None"
+        k = bisect.bisect_right(self.ns_begins, point) - 1
+        while k >= 0 and self.ns_names[k][0] > point:
+            k -= 1
+        if k >= 0:
+            return self.ns_names[k][1]
@@ -1,15 +1,20 @@
 (ns sublime-clojure-repl.middleware
   (:require
    [clojure.main :as main]
-   [clojure.stacktrace :as stacktrace]
    [clojure.string :as str]
    [nrepl.middleware :as middleware]
+   [nrepl.misc :as misc]
    [nrepl.middleware.print :as print]
    [nrepl.middleware.caught :as caught]
    [nrepl.transport :as transport])
   (:import
    [nrepl.transport Transport]))
 
+(def version
+  ;; set to a hash of this file by the client when it uploads it,
+  ;; reported by "describe" so the same version is not uploaded twice
+  nil)
+
 (defn- root-cause [^Throwable t]
   (when t
     (loop [t t]
@@ -17,9 +22,6 @@
         (recur cause)
         t))))
 
-(defn print-root-trace [^Throwable t]
-  (stacktrace/print-stack-trace (root-cause t)))
-
 (defn trace [^Throwable t]
   (let [trace (with-out-str
                 (.printStackTrace t (java.io.PrintWriter. *out*)))]
@@ -27,6 +29,21 @@
       (subs trace 0 idx)
       trace)))
 
+(defn- lru
+  "Synchronized map that keeps `max` most recently used entries"
+  [max]
+  (java.util.Collections/synchronizedMap
+    (proxy [java.util.LinkedHashMap] [16 0.75 true]
+      (removeEldestEntry [_]
+        (> (.size ^java.util.Map this) max)))))
+
+(defonce ^:private ref-ids
+  (atom 0))
+
+(defonce ^:private throwables
+  ;; root causes of recent exceptions, traces are printed only when asked for
+  (lru 100))
+
 (defn- caught-transport [{:keys [transport] :as msg}]
   (reify Transport
     (recv [this]
@@ -40,42 +57,79 @@
                     {::line   (or (.-line throwable) (:clojure.error/line (ex-data throwable)))
                      ::column (:clojure.error/column (ex-data throwable))
                      ::source (or (.-source throwable) (:clojure.error/source (ex-data throwable)))})
+            ref   (when root
+                    (let [ref (swap! ref-ids inc)]
+                      (.put ^java.util.Map throwables ref root)
+                      ref))
             resp' (cond-> resp
                     root (assoc
                            ::root-ex-msg   (.getMessage root)
                            ::root-ex-class (.getSimpleName (class root))
-                           ::trace         (trace root))
+                           ::trace-ref     ref)
                     loc  (merge loc)
                     data (update ::print/keys (fnil conj []) ::root-ex-data)
                     data (assoc ::root-ex-data data))]
         (transport/send transport resp'))
       this)))
 
+(defn- trace-reply [{:keys [transport ref] :as msg}]
+  (if-some [t (.get ^java.util.Map throwables ref)]
+    (transport/send transport
+      (misc/response-for msg :trace (trace t) :status :done))
+    (transport/send transport
+      (misc/response-for msg :status #{:done :unknown-ref}))))
+
 (defn wrap-errors [handler]
   (fn [msg]
-    (handler (assoc msg :transport (caught-transport msg)))))
+    (if (= "trace" (:op msg))
+      (trace-reply msg)
+      (handler (assoc msg :transport (caught-transport msg))))))
 
 (middleware/set-descriptor!
   #'wrap-errors
   {:requires #{#'caught/wrap-caught} ;; run inside wrap-caught
    :expects #{"eval"} ;; but outside of "eval"
-   :handles {}})
+   :describe-fn (fn [_] {::version version})
+   :handles {"trace"
+             {:doc      "Prints stack trace of an exception caught by eval"
+              :requires {"ref" "::trace-ref returned by eval"}
+              :returns  {"trace" "Printed stack trace"}}}})
 
-(defn- output-transport [{:keys [transport] :as msg}]
-  (reify Transport
-    (recv [this]
-      (transport/recv transport))
-    (recv [this timeout]
-      (transport/recv transport timeout))
-    (send [this resp]
-      (when-some [out (:out resp)]
-        (.print System/out out)
-        (.flush System/out))
-      (when-some [err (:err resp)]
-        (.print System/err err)
-        (.flush System/err))
-      (transport/send transport resp)
-      this)))
+(defn- output-transport
+  "Echoes :out/:err to the JVM's own streams. If request has ::output-limit,
+   stops sending output to the client once that many characters were sent,
+   so a runaway print loop can't flood the connection"
+  [{:keys [transport] :as msg}]
+  (let [limit (::output-limit msg)
+        sent  (atom 0)]
+    (reify Transport
+      (recv [this]
+        (transport/recv transport))
+      (recv [this timeout]
+        (transport/recv transport timeout))
+      (send [this resp]
+        (when-some [out (:out resp)]
+          (.print System/out out)
+          (.flush System/out))
+        (when-some [err (:err resp)]
+          (.print System/err err)
+          (.flush System/err))
+        (let [key  (cond (:out resp) :out (:err resp) :err)
+              text (some-> key resp)]
+          (if (and limit text)
+            (let [[before after] (swap-vals! sent + (count text))]
+              (cond
+                (<= after limit)
+                (transport/send transport resp)
+
+                (< before limit)
+                (do
+                  (transport/send transport (assoc resp key (subs text 0 (- limit before))))
+                  (transport/send transport (-> resp
+                                              (dissoc :out)
+                                              (assoc :err (str "\n... output truncated after " limit " characters\n")))))))
+            (transport/send transport resp)))
+        this))))
 
 (defn wrap-output [handler]
   (fn [msg]
@@ -86,3 +140,125 @@
   {:requires #{}
    :expects #{"eval"} ;; run outside of "eval"
    :handles {}})
+
+(defonce ^:private values
+  ;; collections returned by evals, so the client can page through them
+  (lru 100))
+
+(defn- longer-than?
+  "Whether printing value takes more than n characters. Stops printing at n + 1"
+  [value n]
+  (let [written (volatile! 0)
+        add     (fn [k]
+                  (when (> (vswap! written + k) n)
+                    (throw (ex-info "Quota exceeded" {}))))
+        writer  (proxy [java.io.Writer] []
+                  (write
+                    ([x] (add (if (integer? x) 1 (count x))))
+                    ([x off len] (add len)))
+                  (flush [])
+                  (close []))]
+    (try
+      (binding [*out* writer]
+        (pr value))
+      false
+      (catch Throwable _
+        (> @written n)))))
+
+(defn- values-transport [{:keys [transport] :as msg}]
+  (let [quota (::print/quota msg)]
+    (reify Transport
+      (recv [this]
+        (transport/recv transport))
+      (recv [this timeout]
+        (transport/recv transport timeout))
+      (send [this {:keys [value] :as resp}]
+        ;; only values that wrap-print will truncate are worth paging through
+        (if (and quota (coll? value) (seq value) (longer-than? value quota))
+          (let [ref (swap! ref-ids inc)]
+            (.put ^java.util.Map values ref value)
+            (transport/send transport (assoc resp ::value-ref ref)))
+          (transport/send transport resp))
+        this))))
+
+(defn- page
+  "Prints `limit` elements of a kept value starting from `offset`. Only these
+   (and one more, to know if there are any left) are realized"
+  [{:keys [transport ref offset limit] :or {offset 0 limit 50} :as msg}]
+  (if-some [value (.get ^java.util.Map values ref)]
+    (let [items (take (inc limit) (nthnext (seq value) offset))]
+      (transport/send transport
+        (misc/response-for msg
+          :items  (binding [*print-length* 10
+                            *print-level*  3]
+                    (mapv pr-str (take limit items)))
+          :more   (if (> (count items) limit) 1 0)
+          :status :done)))
+    (transport/send transport
+      (misc/response-for msg :status #{:done :unknown-ref}))))
+
+(defn wrap-values [handler]
+  (fn [msg]
+    (cond
+      (= "page" (:op msg)) (page msg)
+      (::keep-value msg)   (handler (assoc msg :transport (values-transport msg)))
+      :else                (handler msg))))
+
+(middleware/set-descriptor!
+  #'wrap-values
+  {:requires #{#'print/wrap-print} ;; run inside wrap-print, sees values before they are printed
+   :expects #{"eval"}
+   :handles {"page"
+             {:doc      "Prints next elements of a collection kept by eval"
+              :requires {"ref" "::value-ref returned by eval"}
+              :optional {"offset" "Index of the first element, 0 by default"
+                         "limit"  "Max number of elements, 50 by default"}
+              :returns  {"items" "Printed elements"
+                         "more"  "1 if there are elements after these, 0 otherwise"}}}})
+
+(defn- ns-vars [ns]
+  (vec
+    (for [[sym v] (ns-publics ns)
+          :let [m (meta v)]]
+      [(str sym)
+       (if-some [arglists (:arglists m)] (pr-str arglists) "")
+       (or (:doc m) "")])))
+
+(defn- vars-reply
+  "Public vars, aliases and referred namespaces of every namespace in one go,
+   or only of `namespaces` if given"
+  [{:keys [transport namespaces] :as msg}]
+  (let [nses (if namespaces
+               (keep #(find-ns (symbol %)) namespaces)
+               (all-ns))]
+    (transport/send transport
+      (misc/response-for msg
+        :vars       (into {} (for [ns nses] [(str ns) (ns-vars ns)]))
+        :aliases    (into {} (for [ns nses]
+                               [(str ns) (into {} (for [[alias target] (ns-aliases ns)]
+                                                    [(str alias) (str target)]))]))
+        :refers     (into {} (for [ns nses]
+                               [(str ns) (->> (vals (ns-refers ns))
+                                           (map #(str (.-ns ^clojure.lang.Var %)))
+                                           (distinct)
+                                           (vec))]))
+        :namespaces (mapv str (all-ns))
+        :status     :done))))
+
+(defn wrap-vars [handler]
+  (fn [msg]
+    (if (= "vars" (:op msg))
+      (vars-reply msg)
+      (handler msg))))
+
+(middleware/set-descriptor!
+  #'wrap-vars
+  {:requires #{}
+   :expects #{}
+   :handles {"vars"
+             {:doc      "Lists public vars of loaded namespaces, for completions and hover docs"
+              :optional {"namespaces" "Names of namespaces to list, all loaded ones by default"}
+              :returns  {"vars"       "ns -> [[name arglists doc]]"
+                         "aliases"    "ns -> alias -> ns"
+                         "refers"     "ns -> namespaces it refers vars from"
+                         "namespaces" "Names of all loaded namespaces"}}}})